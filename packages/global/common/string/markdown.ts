@@ -174,7 +174,10 @@ export const markdownProcess = async ({
 
 export const matchMdImg = (text: string) => {
   const base64Regex = /!\[([^\]]*)\]\((data:image\/[^;]+;base64[^)]+)\)/g;
+  // PDF 解析服务对重复图片只内联一次：首次为 ![img-<hash>](data:...)，之后为 ![img-<hash>](#img-<hash>)
+  const imageRefRegex = /!\[(img-[0-9a-f]+)\]\(#\1\)/g;
   const imageList: ImageType[] = [];
+  const refUuidMap = new Map<string, string>();
 
   text = text.replace(base64Regex, (match, altText, base64Url) => {
     const uuid = `IMAGE_${getNanoid(12)}_IMAGE`;
@@ -186,11 +189,21 @@ export const matchMdImg = (text: string) => {
       base64,
       mime
     });
+    if (/^img-[0-9a-f]+$/.test(altText)) {
+      refUuidMap.set(altText, uuid);
+    }
 
     // 保持原有的 alt 文本，只替换 base64 部分
     return `![${altText}](${uuid})`;
   });
 
+  if (refUuidMap.size > 0) {
+    text = text.replace(imageRefRegex, (match, refId) => {
+      const uuid = refUuidMap.get(refId);
+      return uuid ? `![${refId}](${uuid})` : match;
+    });
+  }
+
   return {
     text,
     imageList
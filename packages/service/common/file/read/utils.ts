@@ -175,9 +175,9 @@ export const readRawContentByFileBuffer = async ({
           return 'Upload load image error';
         }
       })();
-      rawText = rawText.replace(item.uuid, src);
+      rawText = rawText.replaceAll(item.uuid, src);
       if (formatText) {
-        formatText = formatText.replace(item.uuid, src);
+        formatText = formatText.replaceAll(item.uuid, src);
       }
     });
   }
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import asyncio
 import base64
 import io
 import json
 import logging
 import os
-from typing import List, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 import torch
 import uvicorn
-from fastapi import FastAPI, HTTPException, Security
+from fastapi import FastAPI, File, Form, HTTPException, Request, Security, UploadFile
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from PIL import Image, ImageFile
 from pydantic import BaseModel
@@ -24,6 +28,10 @@ warnings.filterwarnings("ignore", category=FutureWarning, module="transformers")
 app = FastAPI()
 security = HTTPBearer()
 env_bearer_token = None
+# 图片解码和缩放在线程池中并行执行，不占用事件循环
+decode_pool = ThreadPoolExecutor(max_workers=int(os.getenv("DECODE_WORKERS", 4)))
+# 长边超过该值的图片先等比缩小，0 表示不缩放
+MAX_IMAGE_SIDE = int(os.getenv("OCR_MAX_IMAGE_SIDE", 0))
 
 
 # GPU显存回收
@@ -58,22 +66,182 @@ class Surya(metaclass=Singleton):
         self.rec_model, self.rec_processor = load_rec_model(
         ), load_rec_processor()
 
-    def run(self, image: ImageFile.ImageFile) -> List[OCRResult]:
-        predictions = run_ocr([image], [self.langs], self.det_model,
+    def run(self, images: List[ImageFile.ImageFile]) -> List[OCRResult]:
+        # 一次调用处理所有图片，检测和识别模型按 BATCH_SIZE 分批
+        predictions = run_ocr(images, [self.langs] * len(images), self.det_model,
                               self.det_processor, self.rec_model,
                               self.rec_processor, self.batch_size)
         return predictions
 
 
-class Chat(object):
+class MemoryPolicy(metaclass=Singleton):
+    # 显存释放策略：adaptive 只在保留显存超过水位线或空闲一段时间后才清空缓存，
+    # always 为原来每批识别后都清空的行为，never 从不主动清空
+    MB = 1024 * 1024
+
+    def __init__(self):
+        self.mode = os.getenv("GPU_MEMORY_POLICY", "adaptive")
+        self.watermark = float(os.getenv("GPU_MEMORY_WATERMARK", 0.8))
+        self.idle_seconds = float(os.getenv("GPU_IDLE_RELEASE_SECONDS", 60))
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.dirty = False
+        self.releases = {"always": 0, "watermark": 0, "idle": 0}
+        self.batches = 0
+        self.images = 0
+        self.busy_seconds = 0.0
+
+    def after_batch(self, images: int, seconds: float):
+        with self.lock:
+            self.batches += 1
+            self.images += images
+            self.busy_seconds += seconds
+            self.last_used = time.monotonic()
+            self.dirty = True
+        if self.mode == "always":
+            self.release("always")
+        elif self.mode == "adaptive" and self.over_watermark():
+            self.release("watermark")
+
+    def over_watermark(self) -> bool:
+        if not torch.cuda.is_available():
+            return False
+        total = torch.cuda.get_device_properties(0).total_memory
+        return torch.cuda.memory_reserved() > self.watermark * total
+
+    def idle_timeout(self) -> Optional[float]:
+        if self.mode == "adaptive" and self.idle_seconds > 0:
+            return self.idle_seconds
+        return None
+
+    def release_if_idle(self):
+        if self.mode == "adaptive" and self.dirty and time.monotonic() - self.last_used >= self.idle_seconds:
+            self.release("idle")
+
+    def release(self, reason: str):
+        torch_gc()
+        with self.lock:
+            self.releases[reason] += 1
+            self.dirty = False
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {
+                "policy": self.mode,
+                "batches": self.batches,
+                "images": self.images,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "images_per_second": round(self.images / self.busy_seconds, 2) if self.busy_seconds else None,
+                "releases": dict(self.releases),
+                "allocator": None
+            }
+        if torch.cuda.is_available():
+            memory_stats = torch.cuda.memory_stats()
+            stats["allocator"] = {
+                "allocated_mb": round(torch.cuda.memory_allocated() / self.MB, 1),
+                "reserved_mb": round(torch.cuda.memory_reserved() / self.MB, 1),
+                "max_reserved_mb": round(torch.cuda.max_memory_reserved() / self.MB, 1),
+                "total_mb": round(torch.cuda.get_device_properties(0).total_memory / self.MB, 1),
+                "alloc_retries": memory_stats.get("num_alloc_retries", 0),
+                "ooms": memory_stats.get("num_ooms", 0)
+            }
+        return stats
+
+
+class OCRBatcher(metaclass=Singleton):
+    # 合并并发请求中的图片：凑满 OCR_MAX_BATCH 张或等待 OCR_MAX_WAIT_MS 后一起调用一次 run_ocr
 
     def __init__(self):
         self.surya = Surya()
+        self.memory = MemoryPolicy()
+        self.max_batch = int(os.getenv("OCR_MAX_BATCH", 32))
+        self.max_wait = int(os.getenv("OCR_MAX_WAIT_MS", 20)) / 1000
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+    async def submit(self, image: ImageFile.ImageFile) -> OCRResult:
+        # 批处理循环意外退出后由下一个请求重新拉起，避免后续请求永远等待
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.batch_loop())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), self.memory.idle_timeout())
+            except asyncio.TimeoutError:
+                # 空闲时释放缓存；与识别在同一个循环中执行，不会和模型调用并发
+                try:
+                    await asyncio.to_thread(self.memory.release_if_idle)
+                except Exception as e:
+                    logging.error(f"释放 GPU 缓存失败: {e}")
+                continue
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 调用方已断开的图片不再识别
+            batch = [(image, future) for image, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                # 模型在线程中运行，期间事件循环继续接收请求，下一批会更满
+                predictions = await asyncio.to_thread(self.run_batch, [image for image, _ in batch])
+            except Exception as e:
+                predictions = [e] * len(batch)
+            for (_, future), prediction in zip(batch, predictions):
+                if future.done():
+                    continue
+                if isinstance(prediction, Exception):
+                    future.set_exception(prediction)
+                else:
+                    future.set_result(prediction)
+
+    def run_batch(self, images: List[ImageFile.ImageFile]) -> List[OCRResult]:
+        start = time.monotonic()
+        try:
+            return self.surya.run(images)
+        except Exception as e:
+            # 整批失败时逐张重试，找出具体出错的图片
+            logging.error(f"批量 OCR 处理失败，逐张重试: {e}")
+            predictions = []
+            for image in images:
+                try:
+                    predictions.append(self.surya.run([image])[0])
+                except Exception as e:
+                    predictions.append(e)
+            return predictions
+        finally:
+            self.memory.after_batch(len(images), time.monotonic() - start)
+
+
+class Chat(object):
+
+    def __init__(self):
+        self.batcher = OCRBatcher()
 
     def base64_to_image(base64_string: str) -> ImageFile.ImageFile:
         image_data = base64.b64decode(base64_string)
-        image_stream = io.BytesIO(image_data)
-        image = Image.open(image_stream)
+        return Chat.load_image(image_data)
+
+    def load_image(source) -> ImageFile.ImageFile:
+        # source 为图片的原始字节或文件对象(如上传文件)
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        image = Image.open(source)
+        # 立即解码，损坏的图片在这里报错而不是在批量识别时
+        image.load()
+        if MAX_IMAGE_SIDE > 0 and max(image.size) > MAX_IMAGE_SIDE:
+            image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
         return image
 
     def sort_text_by_bbox(original_data: List[dict]) -> str:
@@ -100,29 +268,44 @@ class Chat(object):
             string_result += "\n"
         return string_result
 
-    def query_ocr(self, image_base64: str,
-                  sorted: bool) -> str:
-        if image_base64 is None or len(image_base64) == 0:
-            return ""
-        try:
-            image = Chat.base64_to_image(image_base64)
-            ocr_result = self.surya.run(image)
-            result = []
+    async def query_ocr(self, images_base64: List[str],
+                        sorted: bool) -> Tuple[List[str], List[Optional[str]]]:
+        return await self.recognize(images_base64, Chat.base64_to_image, sorted)
 
-            for text_line in ocr_result[0].text_lines:
-                result.append(text_line.text)
+    async def recognize(self, sources: list, decode,
+                        sorted: bool) -> Tuple[List[str], List[Optional[str]]]:
+        # 用 decode 在线程池中并行解码 sources，返回与输入顺序一致的识别结果和每张图片的错误信息
+        results = [""] * len(sources)
+        errors = [None] * len(sources)
+        loop = asyncio.get_running_loop()
+        jobs = {i: loop.run_in_executor(decode_pool, decode, source)
+                for i, source in enumerate(sources) if source}
+        decoded = await asyncio.gather(*jobs.values(), return_exceptions=True)
+        images, indexes = [], []
+        for i, image in zip(jobs, decoded):
+            if isinstance(image, Exception):
+                logging.error(f"图片解码失败: {image}")
+                errors[i] = f"图片解码失败: {str(image)}"
+                continue
+            images.append(image)
+            indexes.append(i)
+        if not images:
+            return results, errors
 
+        # 每张图片单独排队，与其他请求的图片合并成批，结果按输入顺序取回
+        predictions = await asyncio.gather(*(self.batcher.submit(image) for image in images),
+                                           return_exceptions=True)
+        for i, prediction in zip(indexes, predictions):
+            if isinstance(prediction, Exception):
+                logging.error(f"OCR 处理失败: {prediction}")
+                errors[i] = f"OCR 处理失败: {str(prediction)}"
+                continue
+            result = [text_line.text for text_line in prediction.text_lines]
             if sorted:
                 result = self.sort_text_lines(result)
-
             # 将所有文本行合并成一个字符串，用换行符分隔
-            final_result = "\n".join(result)
-
-            torch_gc()
-            return final_result
-        except Exception as e:
-            logging.error(f"OCR 处理失败: {e}")
-            raise HTTPException(status_code=400, detail=f"OCR 处理失败: {str(e)}")
+            results[i] = "\n".join(result)
+        return results, errors
 
     @staticmethod
     def sort_text_lines(text_lines: List[str]) -> List[str]:
@@ -130,25 +313,66 @@ class Chat(object):
         # 目前只是简单地返回原始列表，因为我们没有位置信息来进行排序
         return text_lines
 
+def verify_token(credentials: HTTPAuthorizationCredentials):
+    token = credentials.credentials
+    if env_bearer_token is not None and token != env_bearer_token:
+        raise HTTPException(status_code=401, detail="无效的令牌")
+
 @app.post('/v1/ocr/text')
 async def handle_post_request(
     image_req: ImageReq,
     credentials: HTTPAuthorizationCredentials = Security(security)):
-    token = credentials.credentials
-    if env_bearer_token is not None and token != env_bearer_token:
-        raise HTTPException(status_code=401, detail="无效的令牌")
+    verify_token(credentials)
     chat = Chat()
     try:
-        results = []
-        for image_base64 in image_req.images:
-            results.append(chat.query_ocr(image_base64, image_req.sorted))
-        return {"error": None, "results": results}
+        results, errors = await chat.query_ocr(image_req.images, image_req.sorted)
+        return {"error": None, "results": results, "errors": errors}
     except HTTPException as he:
         raise he
     except Exception as e:
         logging.error(f"识别报错：{e}")
         raise HTTPException(status_code=500, detail=f"识别出错: {str(e)}")
 
+@app.post('/v1/ocr/file')
+async def handle_file_request(
+    files: List[UploadFile] = File(...),
+    sorted: bool = Form(False),
+    credentials: HTTPAuthorizationCredentials = Security(security)):
+    # multipart 上传，直接从上传的临时文件解码，不经过 base64
+    verify_token(credentials)
+    chat = Chat()
+    try:
+        results, errors = await chat.recognize([file.file for file in files], Chat.load_image, sorted)
+        return {"error": None, "results": results, "errors": errors}
+    except Exception as e:
+        logging.error(f"识别报错：{e}")
+        raise HTTPException(status_code=500, detail=f"识别出错: {str(e)}")
+
+@app.post('/v1/ocr/raw')
+async def handle_raw_request(
+    request: Request,
+    sorted: bool = False,
+    credentials: HTTPAuthorizationCredentials = Security(security)):
+    # 请求体为一张图片的原始字节(Content-Type: application/octet-stream)
+    verify_token(credentials)
+    chat = Chat()
+    try:
+        image_data = bytearray()
+        async for chunk in request.stream():
+            image_data.extend(chunk)
+        results, errors = await chat.recognize([image_data], Chat.load_image, sorted)
+        return {"error": None, "results": results, "errors": errors}
+    except Exception as e:
+        logging.error(f"识别报错：{e}")
+        raise HTTPException(status_code=500, detail=f"识别出错: {str(e)}")
+
+@app.get('/v1/ocr/stats')
+async def handle_stats_request(
+    credentials: HTTPAuthorizationCredentials = Security(security)):
+    verify_token(credentials)
+    batcher = OCRBatcher()
+    return {**batcher.memory.stats(), "queued": batcher.queue.qsize()}
+
 if __name__ == "__main__":
     env_bearer_token = os.getenv("ACCESS_TOKEN")
     try:
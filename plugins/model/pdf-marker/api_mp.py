@@ -1,32 +1,80 @@
 import asyncio
 import base64
 import fitz
+import hashlib
+import re
 import torch.multiprocessing as mp
+import resource
 import shutil
+import tempfile
 import time
-from contextlib import asynccontextmanager
+import unicodedata
+import itertools
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from functools import wraps
 from loguru import logger
-from fastapi import HTTPException, FastAPI, UploadFile, File
-import multiprocessing
+from fastapi import HTTPException, FastAPI, UploadFile, File, Request, Query
+from prometheus_client import Counter as PromCounter, Histogram, make_asgi_app
+import marker.convert as marker_convert
 from marker.output import save_markdown
 from marker.convert import convert_single_pdf
 from marker.models import load_all_models
 import torch
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import os
 app = FastAPI()
+app.mount("/metrics", make_asgi_app())
 model_lst = None
-model_refs = None
+stage_timings = defaultdict(float)
+my_pool = None
+my_scheduler = None
 temp_dir = "./temp"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 os.environ['PROCESSES_PER_GPU'] = str(2)
+# 单个 worker 处理多少个文件后回收，0 表示不按任务数回收
+MAX_JOBS_PER_WORKER = int(os.environ.get('MAX_JOBS_PER_WORKER', 200))
+# 单个 worker 常驻内存(MB)超过该值后回收，0 表示不按内存回收
+MAX_WORKER_RSS_MB = int(os.environ.get('MAX_WORKER_RSS_MB', 0))
+# 文本层质量足够好的页面直接用 PyMuPDF 提取，跳过版面/OCR 模型
+TEXT_LAYER_FAST_PATH = os.environ.get('TEXT_LAYER_FAST_PATH', '1') == '1'
+TEXT_LAYER_MIN_CHARS = int(os.environ.get('TEXT_LAYER_MIN_CHARS', 200))
+TEXT_LAYER_MAX_GARBAGE = float(os.environ.get('TEXT_LAYER_MAX_GARBAGE', 0.02))
+TEXT_LAYER_MAX_IMAGE_AREA = float(os.environ.get('TEXT_LAYER_MAX_IMAGE_AREA', 0.3))
+TEXT_LAYER_MAX_DRAWINGS = int(os.environ.get('TEXT_LAYER_MAX_DRAWINGS', 30))
+# 调度：扫描件的预估开销倍数、每等待 1 秒抵扣的页数、是否按租户公平调度
+SCANNED_COST_FACTOR = float(os.environ.get('SCANNED_COST_FACTOR', 3))
+SCHEDULER_AGING_RATE = float(os.environ.get('SCHEDULER_AGING_RATE', 2))
+SCHEDULER_TENANT_FAIRNESS = os.environ.get('SCHEDULER_TENANT_FAIRNESS', '0') == '1'
+# marker.convert 内部调用的函数 -> 统计阶段
+MARKER_STAGES = {
+    "get_text_blocks": "pdf_open",
+    "surya_detection": "layout",
+    "surya_layout": "layout",
+    "surya_order": "layout",
+    "run_ocr": "ocr",
+    "format_tables": "tables_equations",
+    "replace_equations": "tables_equations",
+    "extract_images": "markdown",
+    "merge_spans": "markdown",
+    "merge_lines": "markdown",
+    "get_full_text": "markdown",
+}
+PAGE_BUCKETS = ((4, "1-4"), (19, "5-19"), (99, "20-99"), (499, "100-499"))
+STAGE_SECONDS = Histogram("marker_stage_seconds", "Time spent per pipeline stage",
+                          ["stage", "pages"], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+PAGES_TOTAL = PromCounter("marker_pages_total", "Pages converted", ["path"])
+# 重复图片去重：ref 只内联一次后续引用，drop 去掉重复出现的装饰图，off 关闭
+IMAGE_DEDUP_MODE = os.environ.get('IMAGE_DEDUP_MODE', 'ref')
+IMAGE_DECORATIVE_MIN_REPEATS = int(os.environ.get('IMAGE_DECORATIVE_MIN_REPEATS', 3))
+BASE64_IMAGE_PATTERN = re.compile(r'!\[([^\]]*)\]\((data:image/[^;]+;base64,([^)]+))\)')
+MATH_FONT_HINTS = ("math", "cmmi", "cmsy", "cmex", "symbol", "stix")
 
-def worker_init(counter, lock):
+def worker_init(worker_id):
     global model_lst
     num_gpus = torch.cuda.device_count()
     processes_per_gpu = int(os.environ.get('PROCESSES_PER_GPU', 1))
-    with lock:
-        worker_id = counter.value
-        counter.value += 1
     if num_gpus == 0:
         device = 'cpu'
     else:
@@ -34,6 +82,7 @@ def worker_init(counter, lock):
         if device_id >= num_gpus:
             raise ValueError(f"Worker ID {worker_id} exceeds available GPUs ({num_gpus}).")
         device = f'cuda:{device_id}'
+    instrument_marker()
     model_lst = load_all_models(device=device, dtype=torch.float32)
     print(f"Worker {worker_id}: Models loaded successfully on {device}!")
     for model in model_lst:
@@ -41,12 +90,419 @@ def worker_init(counter, lock):
             continue
         model.share_memory()
 
-def process_file_with_multiprocessing(temp_file_path):
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_timings[stage] += time.perf_counter() - start
+
+def timed(stage, fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with timed_stage(stage):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def instrument_marker():
+    # convert_single_pdf 通过模块全局变量调用各阶段函数，替换为计时版本即可拿到分阶段耗时
+    for fn_name, stage in MARKER_STAGES.items():
+        fn = getattr(marker_convert, fn_name, None)
+        if fn is not None and not hasattr(fn, "__wrapped__"):
+            setattr(marker_convert, fn_name, timed(stage, fn))
+
+def page_bucket(pages):
+    for upper, label in PAGE_BUCKETS:
+        if pages <= upper:
+            return label
+    return "500+"
+
+def worker_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        # 非 Linux 环境退化为峰值内存
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def worker_ping():
+    return {"pid": os.getpid(), "rss_mb": worker_rss_mb()}
+
+def run_job(fn, *args):
+    return fn(*args), worker_ping()
+
+class WorkerSlot:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.executor = None
+        self.standby = None
+        self.standby_ready = False
+        self.standby_info = None
+        self.busy = False
+        self.ready = False
+        self.pid = None
+        self.rss_mb = 0.0
+        self.jobs = 0
+        self.total_jobs = 0
+        self.generation = 0
+
+class RecyclingPool:
+    """每个 worker 独占一个单进程执行器，按任务数或内存上限回收。
+
+    替换进程会先加载好模型再接管，旧进程在空闲后退出，回收不增加请求延迟。
+    """
+
+    def __init__(self, size, max_jobs=0, max_rss_mb=0):
+        self.slots = [WorkerSlot(worker_id) for worker_id in range(size)]
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.idle = asyncio.Queue()
+        self.tasks = set()
+
+    def _spawn(self, worker_id):
+        return ProcessPoolExecutor(max_workers=1, initializer=worker_init, initargs=(worker_id,))
+
+    def _background(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _warm(self, slot):
+        loop = asyncio.get_running_loop()
+        try:
+            info = await loop.run_in_executor(slot.executor, worker_ping)
+        except Exception as e:
+            logger.error(f"Worker {slot.worker_id} failed to start: {e}")
+            return
+        slot.pid, slot.rss_mb, slot.ready = info["pid"], info["rss_mb"], True
+
+    async def _warm_standby(self, slot):
+        loop = asyncio.get_running_loop()
+        try:
+            info = await loop.run_in_executor(slot.standby, worker_ping)
+        except Exception as e:
+            logger.error(f"Worker {slot.worker_id} replacement failed to start: {e}")
+            slot.standby.shutdown(wait=False)
+            slot.standby = None
+            return
+        slot.standby_ready = True
+        slot.standby_info = info
+        if not slot.busy:
+            self._swap(slot)
+
+    def _swap(self, slot):
+        old = slot.executor
+        slot.executor, slot.standby, slot.standby_ready = slot.standby, None, False
+        slot.pid, slot.rss_mb = slot.standby_info["pid"], slot.standby_info["rss_mb"]
+        slot.jobs = 0
+        slot.generation += 1
+        old.shutdown(wait=False)
+        logger.info(f"Worker {slot.worker_id} recycled, now pid {slot.pid} (generation {slot.generation})")
+
+    def _should_recycle(self, slot):
+        if self.max_jobs and slot.jobs >= self.max_jobs:
+            return True
+        return bool(self.max_rss_mb and slot.rss_mb >= self.max_rss_mb)
+
+    def _after_job(self, slot):
+        if slot.standby_ready:
+            self._swap(slot)
+        elif slot.standby is None and self._should_recycle(slot):
+            logger.info(f"Worker {slot.worker_id} reached {slot.jobs} jobs / {slot.rss_mb:.0f}MB, warming replacement")
+            slot.standby = self._spawn(slot.worker_id)
+            self._background(self._warm_standby(slot))
+
+    def start(self):
+        for slot in self.slots:
+            slot.executor = self._spawn(slot.worker_id)
+            self._background(self._warm(slot))
+            self.idle.put_nowait(slot)
+
+    def _release(self, slot, future):
+        error = None if future.cancelled() else future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # worker 异常退出(如 OOM)，立即换一个新进程
+            logger.error(f"Worker {slot.worker_id} died, respawning")
+            slot.executor.shutdown(wait=False)
+            slot.executor, slot.ready, slot.jobs = self._spawn(slot.worker_id), False, 0
+            slot.generation += 1
+            self._background(self._warm(slot))
+        else:
+            if error is None and not future.cancelled():
+                _, info = future.result()
+                slot.pid, slot.rss_mb = info["pid"], info["rss_mb"]
+            slot.jobs += 1
+            slot.total_jobs += 1
+        slot.busy = False
+        self._after_job(slot)
+        self.idle.put_nowait(slot)
+
+    async def submit(self, fn, *args):
+        slot = await self.idle.get()
+        slot.busy = True
+        future = asyncio.get_running_loop().run_in_executor(slot.executor, run_job, fn, *args)
+        # 调用方被取消时进程里的任务仍在执行，等任务真正结束后再归还 worker
+        future.add_done_callback(lambda done: self._release(slot, done))
+        result, _ = await asyncio.shield(future)
+        return result
+
+    def stats(self):
+        return [{
+            "worker_id": slot.worker_id,
+            "pid": slot.pid,
+            "generation": slot.generation,
+            "ready": slot.ready,
+            "busy": slot.busy,
+            "recycling": slot.standby is not None,
+            "jobs": slot.jobs,
+            "total_jobs": slot.total_jobs,
+            "rss_mb": round(slot.rss_mb, 1),
+        } for slot in self.slots]
+
+    def shutdown(self):
+        for slot in self.slots:
+            for executor in (slot.executor, slot.standby):
+                if executor is not None:
+                    executor.shutdown(wait=True)
+
+class CostScheduler:
+    """按预估开销做短作业优先调度，放在进程池前面。
+
+    等待越久优先级越高(aging)，避免大文件饿死；开启租户公平后优先调度
+    当前占用 worker 开销最少的租户，相同时轮到最久没被调度的租户。
+    """
+
+    def __init__(self, pool, capacity, aging_rate=0.0, tenant_fairness=False):
+        self.pool = pool
+        self.capacity = capacity
+        self.aging_rate = aging_rate
+        self.tenant_fairness = tenant_fairness
+        self.waiting = []
+        self.running = 0
+        self.running_cost = defaultdict(float)
+        self.last_served = {}
+        self.seq = itertools.count()
+
+    def _priority(self, job, now):
+        return job["cost"] - self.aging_rate * (now - job["enqueued"]), job["seq"]
+
+    def _pick(self):
+        now = time.monotonic()
+        candidates = self.waiting
+        if self.tenant_fairness:
+            tenant = min({job["tenant"] for job in self.waiting},
+                         key=lambda t: (self.running_cost[t], self.last_served.get(t, 0)))
+            candidates = [job for job in self.waiting if job["tenant"] == tenant]
+        return min(candidates, key=lambda job: self._priority(job, now))
+
+    def _dispatch(self):
+        while self.running < self.capacity and self.waiting:
+            job = self._pick()
+            self.waiting.remove(job)
+            self.running += 1
+            self.running_cost[job["tenant"]] += job["cost"]
+            self.last_served[job["tenant"]] = time.monotonic()
+            job["turn"].set_result(None)
+
+    def _finish(self, job):
+        self.running -= 1
+        self.running_cost[job["tenant"]] -= job["cost"]
+        if self.running_cost[job["tenant"]] <= 0:
+            del self.running_cost[job["tenant"]]
+            if not any(waiting["tenant"] == job["tenant"] for waiting in self.waiting):
+                self.last_served.pop(job["tenant"], None)
+        self._dispatch()
+
+    async def submit(self, cost, tenant, fn, *args):
+        job = {
+            "cost": cost,
+            "tenant": tenant,
+            "enqueued": time.monotonic(),
+            "seq": next(self.seq),
+            "turn": asyncio.get_running_loop().create_future(),
+        }
+        self.waiting.append(job)
+        self._dispatch()
+        try:
+            await job["turn"]
+        except asyncio.CancelledError:
+            if job in self.waiting:
+                self.waiting.remove(job)
+            else:
+                self._finish(job)
+            raise
+        try:
+            return await self.pool.submit(fn, *args)
+        finally:
+            self._finish(job)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "running": self.running,
+            "waiting": len(self.waiting),
+            "queue": [{
+                "cost": job["cost"],
+                "waited": round(now - job["enqueued"], 1),
+            } for job in sorted(self.waiting, key=lambda job: self._priority(job, now))],
+        }
+
+def estimate_cost(pdf_document, sample_pages=5):
+    # 抽样几页判断是否为扫描件，扫描件要走 OCR，开销按倍数放大
+    total_pages = pdf_document.page_count
+    if total_pages == 0:
+        return 0
+    step = max(1, total_pages // sample_pages)
+    sampled = [pdf_document[i] for i in range(0, total_pages, step)][:sample_pages]
+    text_chars = sum(len(page.get_text("text").strip()) for page in sampled)
+    scanned = text_chars / len(sampled) < 50
+    return total_pages * (SCANNED_COST_FACTOR if scanned else 1)
+
+def inspect_pdf(pdf_path):
+    """返回 (页数, 调度开销)；打开文件和抽样取文本都是阻塞操作，调用方放到线程中执行"""
+    with fitz.open(pdf_path) as pdf_document:
+        return pdf_document.page_count, estimate_cost(pdf_document)
+
+def request_tenant(request):
+    tenant = request.headers.get("x-tenant-id")
+    if tenant:
+        return tenant
+    authorization = request.headers.get("authorization")
+    if not authorization:
+        return "default"
+    # 只用令牌的哈希区分租户，避免原始令牌出现在内存中的调度状态里
+    return "auth-" + hashlib.sha256(authorization.encode()).hexdigest()[:12]
+
+def has_clean_text_layer(page):
+    # 文字太少、乱码多、大图覆盖(扫描件)、表格线/公式字体多的页面都交给模型处理
+    text = page.get_text("text")
+    chars = [c for c in text if not c.isspace()]
+    if len(chars) < TEXT_LAYER_MIN_CHARS:
+        return False
+    garbage = sum(1 for c in chars if c == '\ufffd' or unicodedata.category(c) in ('Cc', 'Co', 'Cn'))
+    if garbage / len(chars) > TEXT_LAYER_MAX_GARBAGE:
+        return False
+    page_area = abs(page.rect) or 1
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    if image_area / page_area > TEXT_LAYER_MAX_IMAGE_AREA:
+        return False
+    if any(hint in font[3].lower() for font in page.get_fonts() for hint in MATH_FONT_HINTS):
+        return False
+    return len(page.get_drawings()) <= TEXT_LAYER_MAX_DRAWINGS
+
+def is_cjk(char):
+    return ord(char) >= 0x2E80
+
+def join_line(paragraph, line):
+    if not paragraph:
+        return line
+    if paragraph.endswith('-'):
+        return paragraph[:-1] + line
+    if is_cjk(paragraph[-1]) or is_cjk(line[0]):
+        return paragraph + line
+    return paragraph + ' ' + line
+
+def body_font_size(pages):
+    sizes = Counter()
+    for page_dict in pages:
+        for block in page_dict["blocks"]:
+            for line in block.get("lines", []):
+                for span in line["spans"]:
+                    sizes[round(span["size"])] += len(span["text"].strip())
+    return sizes.most_common(1)[0][0] if sizes else 10
+
+def text_page_to_markdown(page_dict, body_size):
+    blocks = []
+    for block in page_dict["blocks"]:
+        if block.get("type") == 1:
+            # 图片块按阅读顺序内联，和模型路径一样以 Base64 写入 Markdown
+            if block.get("image"):
+                ext = "jpeg" if block.get("ext") in ("jpg", "jpeg", None) else block["ext"]
+                blocks.append(f'![](data:image/{ext};base64,{base64.b64encode(block["image"]).decode("utf-8")})')
+            continue
+        if block.get("type") != 0:
+            continue
+        paragraph = ""
+        max_size = 0
+        all_bold = True
+        for line in block["lines"]:
+            line_text = ""
+            for span in line["spans"]:
+                span_text = span["text"]
+                if not span_text.strip():
+                    line_text += span_text
+                    continue
+                max_size = max(max_size, span["size"])
+                bold = bool(span["flags"] & 16)
+                all_bold = all_bold and bold
+                line_text += f"**{span_text.strip()}** " if bold else span_text
+            line_text = line_text.strip()
+            if line_text:
+                paragraph = join_line(paragraph, line_text)
+        if not paragraph:
+            continue
+        ratio = max_size / body_size if body_size else 1
+        if len(paragraph) < 200 and (ratio >= 1.2 or (all_bold and len(paragraph) < 80)):
+            level = 1 if ratio >= 1.8 else 2 if ratio >= 1.4 else 3
+            blocks.append('#' * level + ' ' + paragraph.replace('**', '').strip())
+        elif paragraph[0] in "•●▪◦-–":
+            blocks.append('- ' + paragraph[1:].strip())
+        else:
+            blocks.append(paragraph)
+    return '\n\n'.join(blocks)
+
+def route_pages(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        if not TEXT_LAYER_FAST_PATH:
+            return ["model"] * doc.page_count, {}
+        paths = ["text" if has_clean_text_layer(page) else "model" for page in doc]
+        text_pages = {i: doc[i].get_text("dict", sort=True) for i, path in enumerate(paths) if path == "text"}
+    body_size = body_font_size(text_pages.values())
+    return paths, {i: text_page_to_markdown(page_dict, body_size) for i, page_dict in text_pages.items()}
+
+def page_runs(paths):
+    # 把连续的同类页面合并成 (类型, 起始页, 页数)
+    runs = []
+    for i, path in enumerate(paths):
+        if runs and runs[-1][0] == path:
+            runs[-1][2] += 1
+        else:
+            runs.append([path, i, 1])
+    return runs
+
+def convert_pdf(temp_file_path):
     global model_lst
-    full_text, images, out_meta = convert_single_pdf(temp_file_path, model_lst, batch_multiplier=1)
-    fname = os.path.basename(temp_file_path)
-    subfolder_path = save_markdown(r'./result', fname, full_text, images, out_meta)
-    md_content_with_base64_images = embed_images_as_base64(full_text, subfolder_path)
+    with timed_stage("text_layer"):
+        paths, text_markdown = route_pages(temp_file_path)
+    if "text" not in paths:
+        full_text, images, out_meta = convert_single_pdf(temp_file_path, model_lst, batch_multiplier=1)
+        out_meta["page_paths"] = paths
+        return full_text, images, out_meta
+    parts, images, out_meta = [], {}, {}
+    for path, start, count in page_runs(paths):
+        if path == "text":
+            parts.extend(text_markdown[i] for i in range(start, start + count))
+            continue
+        run_text, run_images, run_meta = convert_single_pdf(temp_file_path, model_lst, max_pages=count,
+                                                            start_page=start, batch_multiplier=1)
+        parts.append(run_text)
+        images.update(run_images)
+        out_meta = out_meta or run_meta
+    out_meta["page_paths"] = paths
+    return '\n\n'.join(part for part in parts if part), images, out_meta
+
+def process_file_with_multiprocessing(temp_file_path):
+    stage_timings.clear()
+    start = time.perf_counter()
+    full_text, images, out_meta = convert_pdf(temp_file_path)
+    with timed_stage("image_encoding"):
+        fname = os.path.basename(temp_file_path)
+        subfolder_path = save_markdown(os.path.dirname(temp_file_path), fname, full_text, images, out_meta)
+        md_content_with_base64_images = embed_images_as_base64(full_text, subfolder_path)
+    stage_timings["worker_total"] = time.perf_counter() - start
+    out_meta["stage_timings"] = dict(stage_timings)
     return md_content_with_base64_images, out_meta
 
 @asynccontextmanager
@@ -55,51 +511,69 @@ async def lifespan(app: FastAPI):
         mp.set_start_method('spawn')
     except RuntimeError:
         raise RuntimeError("Set start method to spawn twice. This may be a temporary issue with the script. Please try running it again.")
-    manager = multiprocessing.Manager()
-    worker_counter = manager.Value('i', 0)
-    worker_lock = manager.Lock()
     global my_pool
     gpu_count = torch.cuda.device_count()
-    my_pool = ProcessPoolExecutor(max_workers=gpu_count*int(os.environ.get('PROCESSES_PER_GPU', 1)), initializer=worker_init, initargs=(worker_counter, worker_lock))
+    my_pool = RecyclingPool(max(1, gpu_count*int(os.environ.get('PROCESSES_PER_GPU', 1))),
+                            max_jobs=MAX_JOBS_PER_WORKER, max_rss_mb=MAX_WORKER_RSS_MB)
+    my_pool.start()
+    global my_scheduler
+    my_scheduler = CostScheduler(my_pool, len(my_pool.slots), aging_rate=SCHEDULER_AGING_RATE,
+                                 tenant_fairness=SCHEDULER_TENANT_FAIRNESS)
 
     yield
     global temp_dir
     if temp_dir and os.path.exists(temp_dir):
         shutil.rmtree(temp_dir)
-    del model_lst
-    del model_refs
+    my_pool.shutdown()
     print("Application shutdown, cleaning up...")
 
 app.router.lifespan_context = lifespan
 
 @app.post("/v1/parse/file")
 async def read_file(
-        file: UploadFile = File(...)):
+        request: Request,
+        file: UploadFile = File(...),
+        metrics: bool = Query(False),
+        image_dedup: str = Query(IMAGE_DEDUP_MODE)):
+    scratch_dir = None
     try:
         start_time = time.time()
         global temp_dir
         os.makedirs(temp_dir, exist_ok=True)
-        temp_file_path = os.path.join(temp_dir, file.filename)
-        with open(temp_file_path, "wb") as temp_file:
-            temp_file.write(await file.read())
-        pdf_document = fitz.open(temp_file_path)
-        total_pages = pdf_document.page_count
-        pdf_document.close()
-        global my_pool
-        loop = asyncio.get_event_loop()
-        md_content_with_base64_images, out_meta = await loop.run_in_executor(my_pool, process_file_with_multiprocessing, temp_file_path)
+        scratch_dir = tempfile.mkdtemp(dir=temp_dir)
+        temp_file_path = os.path.join(scratch_dir, "upload.pdf")
+        await spool_upload(file, temp_file_path)
+        total_pages, cost = await asyncio.to_thread(inspect_pdf, temp_file_path)
+        global my_scheduler
+        md_content_with_base64_images, out_meta = await my_scheduler.submit(
+            cost, request_tenant(request), process_file_with_multiprocessing, temp_file_path)
+        md_content_with_base64_images = dedup_images(md_content_with_base64_images, image_dedup)
 
         end_time = time.time()
         duration = end_time - start_time
         print(file.filename+"Total time:", duration)
+        timings = out_meta.get("stage_timings", {})
+        timings["queue"] = max(0.0, duration - timings.get("worker_total", duration))
+        bucket = page_bucket(total_pages)
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.labels(stage=stage, pages=bucket).observe(seconds)
+        for path in out_meta.get("page_paths") or []:
+            PAGES_TOTAL.labels(path=path).inc()
+        data = {
+            "markdown": md_content_with_base64_images,
+            "page": total_pages,
+            "page_paths": out_meta.get("page_paths"),
+            "duration": duration
+        }
+        if metrics:
+            data["metrics"] = {
+                "stages": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+                "pages_per_second": round(total_pages / duration, 3) if duration else None
+            }
         return {
                 "success": True,
                 "message": "",
-                "data": {
-                    "markdown": md_content_with_base64_images,
-                    "page": total_pages,
-                    "duration": duration
-                }
+                "data": data
             }
 
     except Exception as e:
@@ -108,8 +582,52 @@ async def read_file(
 
     finally:
 
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        if scratch_dir and os.path.exists(scratch_dir):
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+async def spool_upload(file, path):
+    # 分块写入磁盘，不把整个上传文件读进内存
+    with open(path, "wb") as temp_file:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            temp_file.write(chunk)
+
+@app.get("/v1/workers")
+async def worker_stats():
+    return {
+        "success": True,
+        "message": "",
+        "data": {
+            "max_jobs_per_worker": MAX_JOBS_PER_WORKER,
+            "max_worker_rss_mb": MAX_WORKER_RSS_MB,
+            "workers": my_pool.stats() if my_pool else [],
+            "scheduler": my_scheduler.stats() if my_scheduler else None
+        }
+    }
+
+def dedup_images(md_content, mode):
+    # 相同图片只内联一次，之后以 ![img-<hash>](#img-<hash>) 引用；drop 模式直接去掉反复出现的装饰图
+    if mode not in ("ref", "drop"):
+        return md_content
+    keys = [hashlib.sha1(match.group(3).encode()).hexdigest()[:16]
+            for match in BASE64_IMAGE_PATTERN.finditer(md_content)]
+    if len(keys) == len(set(keys)) and mode == "ref":
+        return md_content
+    counts = Counter(keys)
+    pending = iter(keys)
+    seen = set()
+
+    def replace(match):
+        key = next(pending)
+        if mode == "drop" and counts[key] >= IMAGE_DECORATIVE_MIN_REPEATS:
+            return ""
+        ref = f"img-{key}"
+        if key in seen:
+            return f"![{ref}](#{ref})"
+        seen.add(key)
+        return f"![{ref}]({match.group(2)})"
+
+    return BASE64_IMAGE_PATTERN.sub(replace, md_content)
+
 def img_to_base64(img_path):
     with open(img_path, "rb") as img_file:
         return base64.b64encode(img_file.read()).decode('utf-8')
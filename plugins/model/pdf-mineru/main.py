@@ -1,19 +1,32 @@
+import fcntl
+import hashlib
+import itertools
 import json
 import os
+import re
+import resource
+import shutil
+import tempfile
+from collections import Counter, defaultdict
 from base64 import b64encode
-from glob import glob
 from io import StringIO
-from typing import Tuple, Union
+from typing import List, Tuple, Union
 
 import uvicorn
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Request, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from loguru import logger
+try:
+    from prometheus_client import Counter as PromCounter, make_asgi_app
+except ImportError:
+    # 未安装 prometheus_client 时不提供 /metrics，其余功能不受影响
+    PromCounter = make_asgi_app = None
 from tempfile import TemporaryDirectory
 from pathlib import Path
 import fitz  # PyMuPDF
 import asyncio
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import torch
 import multiprocessing as mp
 from contextlib import asynccontextmanager
@@ -21,18 +34,49 @@ import time
 
 import magic_pdf.model as model_config
 from magic_pdf.config.enums import SupportedPdfParseMethod
-from magic_pdf.data.data_reader_writer import DataWriter, FileBasedDataWriter
+from magic_pdf.config.make_content_config import DropMode, MakeMode
+from magic_pdf.data.data_reader_writer import DataWriter
 from magic_pdf.data.dataset import PymuDocDataset
-from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
+from magic_pdf.dict2md.ocr_mkcontent import union_make
+from magic_pdf.model.doc_analyze_by_custom_model import ModelSingleton, doc_analyze
 from magic_pdf.operators.models import InferenceResult
 from magic_pdf.operators.pipes import PipeResult
 
 model_config.__use_inside_model__ = True
 
 app = FastAPI()
+if make_asgi_app:
+    app.mount("/metrics", make_asgi_app())
 
 process_variables = {}
 my_pool = None
+my_scheduler = None
+result_cache = None
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 单个 worker 处理多少个文件后回收，0 表示不按任务数回收
+MAX_JOBS_PER_WORKER = int(os.environ.get('MAX_JOBS_PER_WORKER', 200))
+# 单个 worker 常驻内存(MB)超过该值后回收，0 表示不按内存回收
+MAX_WORKER_RSS_MB = int(os.environ.get('MAX_WORKER_RSS_MB', 0))
+# 重复图片去重：ref 只内联一次后续引用，drop 去掉重复出现的装饰图，off 关闭
+IMAGE_DEDUP_MODE = os.environ.get('IMAGE_DEDUP_MODE', 'ref')
+IMAGE_DECORATIVE_MIN_REPEATS = int(os.environ.get('IMAGE_DECORATIVE_MIN_REPEATS', 3))
+BASE64_IMAGE_PATTERN = re.compile(r'!\[([^\]]*)\]\((data:image/[^;]+;base64,([^)]+))\)')
+# 解析方式：auto(整篇判断) / txt / ocr / mixed(逐页判断，只对缺少文本层的页面做 OCR)
+PARSE_METHOD = os.environ.get('PARSE_METHOD', 'auto')
+OCR_PAGE_MIN_CHARS = int(os.environ.get('OCR_PAGE_MIN_CHARS', 50))
+# 超过该页数的 PDF 按页切块，分发到多个 worker 并行解析，0 表示不切分
+PAGE_CHUNK_SIZE = int(os.environ.get('PAGE_CHUNK_SIZE', 50))
+# 流式接口的切块页数，越小首页返回越快
+STREAM_CHUNK_PAGES = int(os.environ.get('STREAM_CHUNK_PAGES', 4))
+# 解析结果缓存：按 PDF 内容 SHA-256 和解析方式缓存最终 Markdown，超过容量按 LRU 淘汰，0 表示关闭
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', './cache')
+RESULT_CACHE_MAX_MB = int(os.environ.get('RESULT_CACHE_MAX_MB', 2048))
+CACHE_REQUESTS = PromCounter("mineru_cache_requests_total", "Result cache lookups", ["result"]) if PromCounter else None
+MD_IMAGE_PATTERN = re.compile(r'!\[[^\]]*\]\(images/([^)]+)\)')
+# 调度：扫描件的预估开销倍数、每等待 1 秒抵扣的页数、是否按租户公平调度
+SCANNED_COST_FACTOR = float(os.environ.get('SCANNED_COST_FACTOR', 3))
+SCHEDULER_AGING_RATE = float(os.environ.get('SCHEDULER_AGING_RATE', 2))
+SCHEDULER_TENANT_FAIRNESS = os.environ.get('SCHEDULER_TENANT_FAIRNESS', '0') == '1'
 
 class MemoryDataWriter(DataWriter):
     def __init__(self):
@@ -53,37 +97,421 @@ class MemoryDataWriter(DataWriter):
     def close(self):
         self.buffer.close()
 
-def worker_init(counter, lock):
+class ResultCache:
+    """磁盘上的解析结果缓存，键为 PDF 内容哈希加解析方式。
+
+    写入先落临时文件再原子替换，淘汰时持有目录下的文件锁，多个进程可以共享同一个缓存目录。
+    读取命中时刷新文件时间，淘汰按最近访问时间进行。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock_path = os.path.join(directory, ".lock")
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.approx_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, digest, parse_method):
+        key = hashlib.sha256(f"{digest}:{parse_method}".encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _entries(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def get(self, digest, parse_method):
+        path = self._path(digest, parse_method)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            if CACHE_REQUESTS:
+                CACHE_REQUESTS.labels(result="miss").inc()
+            return None
+        self.hits += 1
+        if CACHE_REQUESTS:
+            CACHE_REQUESTS.labels(result="hit").inc()
+        return entry
+
+    def put(self, digest, parse_method, entry):
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(digest, parse_method)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.approx_bytes += len(data)
+        if self.approx_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self.approx_bytes = total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "bytes": self.approx_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+class MemoryImageWriter(DataWriter):
+    """在 worker 内存中收集 magic_pdf 输出的图片，按文件名索引"""
+
+    def __init__(self):
+        self.images = {}
+
+    def write(self, path: str, data: bytes) -> None:
+        self.images[os.path.basename(path)] = data
+
+    def write_string(self, path: str, data: str) -> None:
+        self.write(path, data.encode("utf-8"))
+
+def worker_init(worker_id):
     num_gpus = torch.cuda.device_count()
     processes_per_gpu = int(os.environ.get('PROCESSES_PER_GPU', 1))
-    with lock:
-        worker_id = counter.value
-        counter.value += 1
     if num_gpus == 0:
         device = 'cpu'
+        device_id = ''
     else:
         device_id = worker_id // processes_per_gpu
         if device_id >= num_gpus:
             raise ValueError(f"Worker ID {worker_id} exceeds available GPUs ({num_gpus}).")
         device = f'cuda:{device_id}'
     config = {
-        "parse_method": "auto",
+        "parse_method": PARSE_METHOD,
         "ADDITIONAL_KEY": "VALUE"
     }
     converter = init_converter(config, device_id)
     pid = os.getpid()
     process_variables[pid] = converter
+    converter["warm"] = warm_models()
     print(f"Worker {worker_id}: Models loaded successfully on {device}!")
 
+def warm_models():
+    # 初始化时就加载版面/OCR 模型并跑一页，避免部署后第一批文档承担加载和 CUDA 预热开销
+    try:
+        model_manager = ModelSingleton()
+        for ocr in (False, True):
+            model_manager.get_model(ocr=ocr, show_log=False)
+        with fitz.open() as doc:
+            page = doc.new_page()
+            page.insert_text((72, 72), "FastGPT MinerU warmup 预热", fontsize=12)
+            page.draw_rect(fitz.Rect(72, 100, 300, 200))
+            warmup_bytes = doc.tobytes()
+        for parse_method in ("txt", "ocr"):
+            pipe_results, _ = process_pdf_content(warmup_bytes, parse_method, MemoryImageWriter())
+            dump_markdown(pipe_results)
+        return True
+    except Exception as e:
+        logger.exception(f"Model warmup failed: {e}")
+        return False
+
+def worker_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        # 非 Linux 环境退化为峰值内存
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def worker_ping():
+    warm = process_variables.get(os.getpid(), {}).get("warm", False)
+    return {"pid": os.getpid(), "rss_mb": worker_rss_mb(), "warm": warm}
+
+def run_job(fn, *args):
+    return fn(*args), worker_ping()
+
+class WorkerSlot:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.executor = None
+        self.standby = None
+        self.standby_ready = False
+        self.standby_info = None
+        self.busy = False
+        self.ready = False
+        self.pid = None
+        self.rss_mb = 0.0
+        self.jobs = 0
+        self.total_jobs = 0
+        self.generation = 0
+
+class RecyclingPool:
+    """每个 worker 独占一个单进程执行器，按任务数或内存上限回收。
+
+    替换进程会先加载好模型再接管，旧进程在空闲后退出，回收不增加请求延迟。
+    """
+
+    def __init__(self, size, max_jobs=0, max_rss_mb=0):
+        self.slots = [WorkerSlot(worker_id) for worker_id in range(size)]
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.idle = asyncio.Queue()
+        self.tasks = set()
+
+    def _spawn(self, worker_id):
+        return ProcessPoolExecutor(max_workers=1, initializer=worker_init, initargs=(worker_id,))
+
+    def _background(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _warm(self, slot):
+        loop = asyncio.get_running_loop()
+        try:
+            info = await loop.run_in_executor(slot.executor, worker_ping)
+        except Exception as e:
+            logger.error(f"Worker {slot.worker_id} failed to start: {e}")
+            return
+        slot.pid, slot.rss_mb, slot.ready = info["pid"], info["rss_mb"], info["warm"]
+
+    async def _warm_standby(self, slot):
+        loop = asyncio.get_running_loop()
+        try:
+            info = await loop.run_in_executor(slot.standby, worker_ping)
+        except Exception as e:
+            logger.error(f"Worker {slot.worker_id} replacement failed to start: {e}")
+            slot.standby.shutdown(wait=False)
+            slot.standby = None
+            return
+        if not info["warm"]:
+            logger.error(f"Worker {slot.worker_id} replacement failed to warm up, keeping current worker")
+            slot.standby.shutdown(wait=False)
+            slot.standby = None
+            return
+        slot.standby_ready = True
+        slot.standby_info = info
+        if not slot.busy:
+            self._swap(slot)
+
+    def _swap(self, slot):
+        old = slot.executor
+        slot.executor, slot.standby, slot.standby_ready = slot.standby, None, False
+        slot.pid, slot.rss_mb = slot.standby_info["pid"], slot.standby_info["rss_mb"]
+        slot.jobs = 0
+        slot.generation += 1
+        old.shutdown(wait=False)
+        logger.info(f"Worker {slot.worker_id} recycled, now pid {slot.pid} (generation {slot.generation})")
+
+    def _should_recycle(self, slot):
+        if self.max_jobs and slot.jobs >= self.max_jobs:
+            return True
+        return bool(self.max_rss_mb and slot.rss_mb >= self.max_rss_mb)
+
+    def _after_job(self, slot):
+        if slot.standby_ready:
+            self._swap(slot)
+        elif slot.standby is None and self._should_recycle(slot):
+            logger.info(f"Worker {slot.worker_id} reached {slot.jobs} jobs / {slot.rss_mb:.0f}MB, warming replacement")
+            slot.standby = self._spawn(slot.worker_id)
+            self._background(self._warm_standby(slot))
+
+    def start(self):
+        for slot in self.slots:
+            slot.executor = self._spawn(slot.worker_id)
+            self._background(self._warm(slot))
+            self.idle.put_nowait(slot)
+
+    def _release(self, slot, future):
+        error = None if future.cancelled() else future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # worker 异常退出(如 OOM)，立即换一个新进程
+            logger.error(f"Worker {slot.worker_id} died, respawning")
+            slot.executor.shutdown(wait=False)
+            slot.executor, slot.ready, slot.jobs = self._spawn(slot.worker_id), False, 0
+            slot.generation += 1
+            self._background(self._warm(slot))
+        else:
+            if error is None and not future.cancelled():
+                _, info = future.result()
+                slot.pid, slot.rss_mb = info["pid"], info["rss_mb"]
+            slot.jobs += 1
+            slot.total_jobs += 1
+        slot.busy = False
+        self._after_job(slot)
+        self.idle.put_nowait(slot)
+
+    async def submit(self, fn, *args):
+        slot = await self.idle.get()
+        slot.busy = True
+        future = asyncio.get_running_loop().run_in_executor(slot.executor, run_job, fn, *args)
+        # 调用方被取消时进程里的任务仍在执行，等任务真正结束后再归还 worker
+        future.add_done_callback(lambda done: self._release(slot, done))
+        result, _ = await asyncio.shield(future)
+        return result
+
+    def stats(self):
+        return [{
+            "worker_id": slot.worker_id,
+            "pid": slot.pid,
+            "generation": slot.generation,
+            "ready": slot.ready,
+            "busy": slot.busy,
+            "recycling": slot.standby is not None,
+            "jobs": slot.jobs,
+            "total_jobs": slot.total_jobs,
+            "rss_mb": round(slot.rss_mb, 1),
+        } for slot in self.slots]
+
+    def shutdown(self):
+        for slot in self.slots:
+            for executor in (slot.executor, slot.standby):
+                if executor is not None:
+                    executor.shutdown(wait=True)
+
+class CostScheduler:
+    """按预估开销做短作业优先调度，放在进程池前面。
+
+    等待越久优先级越高(aging)，避免大文件饿死；开启租户公平后优先调度
+    当前占用 worker 开销最少的租户，相同时轮到最久没被调度的租户。
+    """
+
+    def __init__(self, pool, capacity, aging_rate=0.0, tenant_fairness=False):
+        self.pool = pool
+        self.capacity = capacity
+        self.aging_rate = aging_rate
+        self.tenant_fairness = tenant_fairness
+        self.waiting = []
+        self.running = 0
+        self.running_cost = defaultdict(float)
+        self.last_served = {}
+        self.seq = itertools.count()
+
+    def _priority(self, job, now):
+        return job["cost"] - self.aging_rate * (now - job["enqueued"]), job["seq"]
+
+    def _pick(self):
+        now = time.monotonic()
+        candidates = self.waiting
+        if self.tenant_fairness:
+            tenant = min({job["tenant"] for job in self.waiting},
+                         key=lambda t: (self.running_cost[t], self.last_served.get(t, 0)))
+            candidates = [job for job in self.waiting if job["tenant"] == tenant]
+        return min(candidates, key=lambda job: self._priority(job, now))
+
+    def _dispatch(self):
+        while self.running < self.capacity and self.waiting:
+            job = self._pick()
+            self.waiting.remove(job)
+            self.running += 1
+            self.running_cost[job["tenant"]] += job["cost"]
+            self.last_served[job["tenant"]] = time.monotonic()
+            job["turn"].set_result(None)
+
+    def _finish(self, job):
+        self.running -= 1
+        self.running_cost[job["tenant"]] -= job["cost"]
+        if self.running_cost[job["tenant"]] <= 0:
+            del self.running_cost[job["tenant"]]
+            if not any(waiting["tenant"] == job["tenant"] for waiting in self.waiting):
+                self.last_served.pop(job["tenant"], None)
+        self._dispatch()
+
+    async def submit(self, cost, tenant, fn, *args):
+        job = {
+            "cost": cost,
+            "tenant": tenant,
+            "enqueued": time.monotonic(),
+            "seq": next(self.seq),
+            "turn": asyncio.get_running_loop().create_future(),
+        }
+        self.waiting.append(job)
+        self._dispatch()
+        try:
+            await job["turn"]
+        except asyncio.CancelledError:
+            if job in self.waiting:
+                self.waiting.remove(job)
+            else:
+                self._finish(job)
+            raise
+        try:
+            return await self.pool.submit(fn, *args)
+        finally:
+            self._finish(job)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "running": self.running,
+            "waiting": len(self.waiting),
+            "queue": [{
+                "cost": job["cost"],
+                "waited": round(now - job["enqueued"], 1),
+            } for job in sorted(self.waiting, key=lambda job: self._priority(job, now))],
+        }
+
+def estimate_cost(pdf_document, sample_pages=5):
+    # 抽样几页判断是否为扫描件，扫描件要走 OCR，开销按倍数放大
+    total_pages = pdf_document.page_count
+    if total_pages == 0:
+        return 0
+    step = max(1, total_pages // sample_pages)
+    sampled = [pdf_document[i] for i in range(0, total_pages, step)][:sample_pages]
+    text_chars = sum(len(page.get_text("text").strip()) for page in sampled)
+    scanned = text_chars / len(sampled) < 50
+    return total_pages * (SCANNED_COST_FACTOR if scanned else 1)
+
+def inspect_pdf(pdf_path):
+    """返回 (页数, 调度开销)；打开文件和抽样取文本都是阻塞操作，调用方放到线程中执行"""
+    with fitz.open(pdf_path) as pdf_document:
+        return pdf_document.page_count, estimate_cost(pdf_document)
+
+def request_tenant(request):
+    tenant = request.headers.get("x-tenant-id")
+    if tenant:
+        return tenant
+    authorization = request.headers.get("authorization")
+    if not authorization:
+        return "default"
+    # 只用令牌的哈希区分租户，避免原始令牌出现在内存中的调度状态里
+    return "auth-" + hashlib.sha256(authorization.encode()).hexdigest()[:12]
+
 def init_converter(config, device_id):
     os.environ["CUDA_VISIBLE_DEVICES"] = str(device_id)
     return config
 
-def img_to_base64(img_path: str) -> str:
-    with open(img_path, "rb") as img_file:
-        return b64encode(img_file.read()).decode('utf-8')
+def image_mime(data: bytes) -> str:
+    return "image/jpeg" if data[:2] == b"\xff\xd8" else "image/png"
 
-def embed_images_as_base64(md_content: str, image_dir: str) -> str:
+def embed_images_as_base64(md_content: str, images: dict) -> str:
     lines = md_content.split('\n')
     new_lines = []
     for line in lines:
@@ -92,91 +520,82 @@ def embed_images_as_base64(md_content: str, image_dir: str) -> str:
             end_idx = line.index(")", start_idx)
             img_rel_path = line[start_idx:end_idx]
             img_name = os.path.basename(img_rel_path)
-            img_path = os.path.join(image_dir, img_name)
-            logger.info(f"Checking image: {img_path}")
-            if os.path.exists(img_path):
-                img_base64 = img_to_base64(img_path)
-                new_line = f"![](data:image/png;base64,{img_base64})"
+            if img_name in images:
+                img_data = images[img_name]
+                img_base64 = b64encode(img_data).decode('utf-8')
+                new_line = f"![](data:{image_mime(img_data)};base64,{img_base64})"
                 new_lines.append(new_line)
             else:
-                logger.warning(f"Image not found: {img_path}")
+                logger.warning(f"Image not found: {img_name}")
                 new_lines.append(line)
         else:
             new_lines.append(line)
     return '\n'.join(new_lines)
 
-def process_pdf(pdf_path, output_dir):
+def dedup_images(md_content, mode, seen=None, counts=None):
+    # 相同图片只内联一次，之后以 ![img-<hash>](#img-<hash>) 引用；drop 模式直接去掉反复出现的装饰图
+    # 流式输出时传入 seen 和 counts，在多次调用之间共享已内联过的图片和累计出现次数
+    if mode not in ("ref", "drop"):
+        return md_content
+    keys = [hashlib.sha1(match.group(3).encode()).hexdigest()[:16]
+            for match in BASE64_IMAGE_PATTERN.finditer(md_content)]
+    if seen is None:
+        if len(keys) == len(set(keys)) and mode == "ref":
+            return md_content
+        seen = set()
+    # 整篇文档一次处理时直接按全文统计；流式时只能按已出现的次数累计，达到阈值后的出现才去掉
+    cumulative = counts is not None
+    if counts is None:
+        counts = Counter(keys)
+    pending = iter(keys)
+
+    def replace(match):
+        key = next(pending)
+        if cumulative:
+            counts[key] += 1
+        if mode == "drop" and counts[key] >= IMAGE_DECORATIVE_MIN_REPEATS:
+            return ""
+        ref = f"img-{key}"
+        if key in seen:
+            return f"![{ref}](#{ref})"
+        seen.add(key)
+        return f"![{ref}]({match.group(2)})"
+
+    return BASE64_IMAGE_PATTERN.sub(replace, md_content)
+
+def process_pdf(pdf_path, parse_method=None, per_page=False):
     try:
         pid = os.getpid()
         config = process_variables.get(pid, "No variable")
-        parse_method = config["parse_method"]
+        parse_method = parse_method or config["parse_method"]
         
         with open(str(pdf_path), "rb") as f:
             pdf_bytes = f.read()
         
-        output_path = Path(output_dir) / f"{Path(pdf_path).stem}_output"
-        os.makedirs(str(output_path), exist_ok=True)
-        image_dir = os.path.join(str(output_path), "images")
-        os.makedirs(image_dir, exist_ok=True)
-        image_writer = FileBasedDataWriter(str(output_path))
+        # 图片只保存在 worker 内存中，直接在 worker 内嵌入 Base64
+        image_writer = MemoryImageWriter()
         
         # 处理 PDF
-        infer_result, pipe_result = process_pdf_content(pdf_bytes, parse_method, image_writer)
-        
-        md_content_writer = MemoryDataWriter()
-        pipe_result.dump_md(md_content_writer, "", "images")
-        md_content = md_content_writer.get_value()
-        md_content_writer.close()
+        pipe_results, page_modes = process_pdf_content(pdf_bytes, parse_method, image_writer)
+        if per_page:
+            page_texts = page_markdowns(pipe_results, len(page_modes))
+            md_content = "\n\n".join(page_texts)
+        else:
+            md_content = dump_markdown(pipe_results)
         
-        # 获取保存的图片路径
-        image_paths = glob(os.path.join(image_dir, "*.jpg"))
-        logger.info(f"Saved images by magic_pdf: {image_paths}")
+        # 只补回 Markdown 中引用了但 magic_pdf 没有保存的图片
+        recover_missing_images(md_content, pipe_results, pdf_bytes, image_writer, set(image_writer.images))
         
-        # 如果 magic_pdf 未保存足够图片，使用 fitz 提取
-        if not image_paths or len(image_paths) < 3:  # 假设至少 3 张图片
-            logger.warning("Insufficient images saved by magic_pdf, falling back to fitz extraction")
-            image_map = {}
-            original_names = []
-            # 收集 Markdown 中的所有图片文件名
-            for line in md_content.split('\n'):
-                if line.startswith("![") and "](" in line and ")" in line:
-                    start_idx = line.index("](") + 2
-                    end_idx = line.index(")", start_idx)
-                    img_rel_path = line[start_idx:end_idx]
-                    original_names.append(os.path.basename(img_rel_path))
-            
-            # 提取图片并映射
-            with fitz.open(pdf_path) as doc:
-                img_counter = 0
-                for page_num, page in enumerate(doc):
-                    for img_index, img in enumerate(page.get_images(full=True)):
-                        xref = img[0]
-                        base = doc.extract_image(xref)
-                        if img_counter < len(original_names):
-                            img_name = original_names[img_counter]  # 使用 Markdown 中的原始文件名
-                        else:
-                            img_name = f"page_{page_num}_img_{img_index}.jpg"
-                        img_path = os.path.join(image_dir, img_name)
-                        with open(img_path, "wb") as f:
-                            f.write(base["image"])
-                        if img_counter < len(original_names):
-                            image_map[original_names[img_counter]] = img_name
-                        img_counter += 1
-            
-            image_paths = glob(os.path.join(image_dir, "*.jpg"))
-            logger.info(f"Images extracted by fitz: {image_paths}")
-            
-            # 更新 Markdown（仅在必要时替换）
-            for original_name, new_name in image_map.items():
-                if original_name != new_name:
-                    md_content = md_content.replace(f"images/{original_name}", f"images/{new_name}")
-        
-        return {
+        results = {
             "status": "success",
-            "text": md_content,
-            "output_path": str(output_path),
-            "images": image_paths
+            "images": len(image_writer.images),
+            "page_modes": page_modes
         }
+        if per_page:
+            results["page_texts"] = [embed_images_as_base64(text, image_writer.images) for text in page_texts]
+        else:
+            results["text"] = embed_images_as_base64(md_content, image_writer.images)
+        return results
     except Exception as e:
         logger.error(f"Error processing PDF: {str(e)}")
         return {
@@ -185,26 +604,112 @@ def process_pdf(pdf_path, output_dir):
             "file": str(pdf_path)
         }
 
+def image_locations(pipe_results):
+    # 在 middle json 中找出每个图片/表格截图对应的页码和 bbox
+    locations = {}
+
+    def walk(node, page_idx):
+        if isinstance(node, dict):
+            if node.get("image_path") and node.get("bbox"):
+                locations[os.path.basename(node["image_path"])] = (page_idx, node["bbox"])
+            for value in node.values():
+                walk(value, page_idx)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, page_idx)
+
+    for pipe_result in pipe_results:
+        for page_info in json.loads(pipe_result.get_middle_json()).get("pdf_info", []):
+            walk(page_info, page_info.get("page_idx", 0))
+    return locations
+
+def recover_missing_images(md_content, pipe_results, pdf_bytes, image_writer, saved_names):
+    missing = {name for name in MD_IMAGE_PATTERN.findall(md_content) if name not in saved_names}
+    if not missing:
+        return 0
+    logger.warning(f"{len(missing)} referenced images were not saved by magic_pdf, cropping them from the PDF")
+    locations = image_locations(pipe_results)
+    recovered = 0
+    with fitz.open("pdf", pdf_bytes) as doc:
+        for name in missing:
+            if name not in locations:
+                logger.warning(f"No page/bbox found for image: {name}")
+                continue
+            page_idx, bbox = locations[name]
+            page = doc[page_idx]
+            clip = fitz.Rect(bbox) & page.rect
+            if clip.is_empty:
+                continue
+            pixmap = page.get_pixmap(clip=clip, matrix=fitz.Matrix(3, 3))
+            image_writer.write(f"images/{name}", pixmap.tobytes("jpeg"))
+            recovered += 1
+    return recovered
+
+def page_needs_ocr(page):
+    # 文字太少或乱码(无法映射为 unicode)的页面视为缺少文本层
+    text = page.get_text("text")
+    chars = [c for c in text if not c.isspace()]
+    if len(chars) < OCR_PAGE_MIN_CHARS:
+        return True
+    return sum(1 for c in chars if c == '\ufffd') / len(chars) > 0.05
+
+def classify_pages(pdf_bytes):
+    with fitz.open("pdf", pdf_bytes) as doc:
+        return ["ocr" if page_needs_ocr(page) else "txt" for page in doc]
+
+def page_runs(page_modes):
+    # 把连续的同类页面合并成 (模式, 起始页, 结束页)
+    runs = []
+    for i, mode in enumerate(page_modes):
+        if runs and runs[-1][0] == mode:
+            runs[-1][2] = i
+        else:
+            runs.append([mode, i, i])
+    return runs
+
+def run_pipe(ds, ocr, image_writer, start_page_id=0, end_page_id=None):
+    infer_result: InferenceResult = ds.apply(doc_analyze, ocr=ocr, start_page_id=start_page_id, end_page_id=end_page_id)
+    if ocr:
+        return infer_result.pipe_ocr_mode(image_writer, start_page_id=start_page_id, end_page_id=end_page_id)
+    return infer_result.pipe_txt_mode(image_writer, start_page_id=start_page_id, end_page_id=end_page_id)
+
 def process_pdf_content(pdf_bytes, parse_method, image_writer):
+    """返回按页序排列的 PipeResult 列表以及每页使用的模式"""
     ds = PymuDocDataset(pdf_bytes)
-    infer_result: InferenceResult = None
-    pipe_result: PipeResult = None
+    if parse_method == "mixed":
+        page_modes = classify_pages(pdf_bytes)
+        pipe_results = [run_pipe(ds, mode == "ocr", image_writer, start, end)
+                        for mode, start, end in page_runs(page_modes)]
+        return pipe_results, page_modes
 
     if parse_method == "ocr":
-        infer_result = ds.apply(doc_analyze, ocr=True)
-        pipe_result = infer_result.pipe_ocr_mode(image_writer)
+        ocr = True
     elif parse_method == "txt":
-        infer_result = ds.apply(doc_analyze, ocr=False)
-        pipe_result = infer_result.pipe_txt_mode(image_writer)
+        ocr = False
     else:  # auto
-        if ds.classify() == SupportedPdfParseMethod.OCR:
-            infer_result = ds.apply(doc_analyze, ocr=True)
-            pipe_result = infer_result.pipe_ocr_mode(image_writer)
-        else:
-            infer_result = ds.apply(doc_analyze, ocr=False)
-            pipe_result = infer_result.pipe_txt_mode(image_writer)
+        ocr = ds.classify() == SupportedPdfParseMethod.OCR
+    pipe_result: PipeResult = run_pipe(ds, ocr, image_writer)
+    return [pipe_result], ["ocr" if ocr else "txt"] * len(ds)
 
-    return infer_result, pipe_result
+def dump_markdown(pipe_results):
+    parts = []
+    for pipe_result in pipe_results:
+        md_content_writer = MemoryDataWriter()
+        pipe_result.dump_md(md_content_writer, "", "images")
+        parts.append(md_content_writer.get_value())
+        md_content_writer.close()
+    return "\n\n".join(part.strip("\n") for part in parts if part.strip())
+
+def page_markdowns(pipe_results, total_pages):
+    # 按页从 middle json 生成 Markdown；mixed 模式下每段只对自己的页面有内容，空页不覆盖已有结果
+    page_texts = [""] * total_pages
+    for pipe_result in pipe_results:
+        for page_info in json.loads(pipe_result.get_middle_json()).get("pdf_info", []):
+            page_idx = page_info.get("page_idx", 0)
+            text = union_make([page_info], MakeMode.MM_MD, DropMode.NONE, "images")
+            if text.strip() and page_idx < total_pages:
+                page_texts[page_idx] = text.strip("\n")
+    return page_texts
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -213,31 +718,47 @@ async def lifespan(app: FastAPI):
     except RuntimeError:
         raise RuntimeError("Set start method to spawn twice. This may be a temporary issue with the script. Please try running it again.")
     global my_pool
-    manager = mp.Manager()
-    worker_counter = manager.Value('i', 0)
-    worker_lock = manager.Lock()
     gpu_count = torch.cuda.device_count()
-    my_pool = ProcessPoolExecutor(max_workers=gpu_count * int(os.environ.get('PROCESSES_PER_GPU', 1)), 
-                                  initializer=worker_init, initargs=(worker_counter, worker_lock))
+    my_pool = RecyclingPool(max(1, gpu_count * int(os.environ.get('PROCESSES_PER_GPU', 1))),
+                            max_jobs=MAX_JOBS_PER_WORKER, max_rss_mb=MAX_WORKER_RSS_MB)
+    my_pool.start()
+    global my_scheduler
+    my_scheduler = CostScheduler(my_pool, len(my_pool.slots), aging_rate=SCHEDULER_AGING_RATE,
+                                 tenant_fairness=SCHEDULER_TENANT_FAIRNESS)
+    global result_cache
+    if RESULT_CACHE_MAX_MB > 0:
+        result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024)
     yield
     if my_pool:
-        my_pool.shutdown(wait=True)
+        my_pool.shutdown()
     print("Application shutdown, cleaning up...")
 
 app.router.lifespan_context = lifespan
 
 @app.post("/v2/parse/file")
-async def process_pdfs(file: UploadFile = File(...)):
+async def process_pdfs(request: Request, file: UploadFile = File(...),
+                       parse_method: str = Query(PARSE_METHOD),
+                       image_dedup: str = Query(IMAGE_DEDUP_MODE),
+                       chunk_pages: int = Query(PAGE_CHUNK_SIZE)):
     s_time = time.time()
     with TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir) / file.filename
-        with open(str(temp_path), "wb") as buffer:
-            buffer.write(await file.read())
+        temp_path = Path(temp_dir) / "upload.pdf"
+        digest = await spool_upload(file, str(temp_path))
+        cached = await cache_lookup(digest, parse_method)
+        if cached:
+            return {
+                "success": True,
+                "message": "",
+                "markdown": dedup_images(cached["text"], image_dedup),
+                "pages": cached["pages"],
+                "page_modes": cached["page_modes"],
+                "chunks": [],
+                "cached": True
+            }
         
         # 验证 PDF 文件
         try:
-            with fitz.open(str(temp_path)) as pdf_document:
-                total_pages = pdf_document.page_count
+            total_pages, cost = await asyncio.to_thread(inspect_pdf, str(temp_path))
         except fitz.fitz.FileDataError:
             return JSONResponse(content={"success": False, "message": "", "error": "Invalid PDF file"}, status_code=400)
         except Exception as e:
@@ -245,31 +766,26 @@ async def process_pdfs(file: UploadFile = File(...)):
             return JSONResponse(content={"success": False, "message": "", "error": f"Internal server error: {str(e)}"}, status_code=500)
         
         try:
-            loop = asyncio.get_running_loop()
-            results = await loop.run_in_executor(
-                my_pool,
-                process_pdf,
-                str(temp_path),
-                str(temp_dir)
-            )
-            
-            if results.get("status") == "error":
-                return JSONResponse(content={
-                    "success": False,
-                    "message": "",
-                    "error": results.get("message")
-                }, status_code=500)
-            
-            # 嵌入 Base64
-            image_dir = os.path.join(results.get("output_path"), "images")
-            md_content_with_base64 = embed_images_as_base64(results.get("text"), image_dir)
+            results = await parse_pdf_file(str(temp_path), temp_dir, total_pages, cost,
+                                           request_tenant(request), parse_method, chunk_pages)
+            await cache_store(digest, parse_method, results["text"], total_pages, results["page_modes"])
+            md_content_with_base64 = dedup_images(results["text"], image_dedup)
             
             return {
                 "success": True,
                 "message": "",
                 "markdown": md_content_with_base64,
-                "pages": total_pages
+                "pages": total_pages,
+                "page_modes": results["page_modes"],
+                "chunks": results["chunks"],
+                "cached": False
             }
+        except ParseError as e:
+            return JSONResponse(content={
+                "success": False,
+                "message": "",
+                "error": str(e)
+            }, status_code=500)
         except Exception as e:
             logger.error(f"Error in process_pdfs: {str(e)}")
             return JSONResponse(content={
@@ -278,5 +794,234 @@ async def process_pdfs(file: UploadFile = File(...)):
                 "error": f"Internal server error: {str(e)}"
             }, status_code=500)
 
+class ParseError(Exception):
+    pass
+
+def split_pdf(pdf_path, work_dir, total_pages, chunk_pages):
+    """按页切成多个子 PDF，返回 [(起始页, 结束页, 子文件路径)]"""
+    if chunk_pages <= 0 or total_pages <= chunk_pages:
+        return [(0, total_pages - 1, pdf_path)]
+    chunks = []
+    with fitz.open(pdf_path) as doc:
+        for start in range(0, total_pages, chunk_pages):
+            end = min(start + chunk_pages, total_pages) - 1
+            chunk_path = os.path.join(work_dir, f"chunk_{start:05d}.pdf")
+            with fitz.open() as chunk_doc:
+                chunk_doc.insert_pdf(doc, from_page=start, to_page=end)
+                chunk_doc.save(chunk_path)
+            chunks.append((start, end, chunk_path))
+    return chunks
+
+async def parse_chunk(start, end, chunk_path, cost, tenant, parse_method, per_page=False):
+    s_time = time.time()
+    results = await my_scheduler.submit(cost, tenant, process_pdf, chunk_path, parse_method, per_page)
+    if results.get("status") == "error":
+        raise ParseError(results.get("message"))
+    results["chunk"] = {"start_page": start, "end_page": end, "duration": round(time.time() - s_time, 3)}
+    return results
+
+async def parse_pdf_file(pdf_path, work_dir, total_pages, cost, tenant, parse_method, chunk_pages):
+    """大文件切块后在进程池中并行解析，按页序拼接 Markdown 和每页的解析模式"""
+    chunks = await asyncio.to_thread(split_pdf, pdf_path, work_dir, total_pages, chunk_pages)
+    tasks = [asyncio.create_task(parse_chunk(start, end, chunk_path,
+                                             cost * (end - start + 1) / max(total_pages, 1), tenant, parse_method))
+             for start, end, chunk_path in chunks]
+    try:
+        chunk_results = await asyncio.gather(*tasks)
+    except BaseException:
+        # gather 不会取消其余块，某一块失败后撤销仍在排队或解析的块，释放工作进程
+        for task in tasks:
+            task.cancel()
+        raise
+    return {
+        "text": "\n\n".join(result["text"] for result in chunk_results if result["text"]),
+        "page_modes": [mode for result in chunk_results for mode in result.get("page_modes") or []],
+        "chunks": [result["chunk"] for result in chunk_results]
+    }
+
+@app.post("/v2/parse/batch")
+async def process_pdf_batch(request: Request, files: List[UploadFile] = File(...),
+                            parse_method: str = Query(PARSE_METHOD),
+                            image_dedup: str = Query(IMAGE_DEDUP_MODE),
+                            chunk_pages: int = Query(PAGE_CHUNK_SIZE)):
+    """一次上传多个文件，所有文件的页块一起进入调度队列，每个文件完成后立即以 NDJSON 返回一行结果"""
+    tenant = request_tenant(request)
+    work_dir = tempfile.mkdtemp()
+    uploads = []
+    try:
+        # 响应开始后上传文件会被关闭，先全部落盘
+        for index, file in enumerate(files):
+            file_dir = os.path.join(work_dir, str(index))
+            os.makedirs(file_dir)
+            file_path = os.path.join(file_dir, "upload.pdf")
+            digest = await spool_upload(file, file_path)
+            uploads.append((index, file.filename, file_dir, file_path, digest))
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    async def parse_one(index, filename, file_dir, file_path, digest):
+        s_time = time.time()
+        item = {"index": index, "filename": filename}
+        cached = await cache_lookup(digest, parse_method)
+        if cached:
+            return {
+                **item,
+                "success": True,
+                "markdown": dedup_images(cached["text"], image_dedup),
+                "pages": cached["pages"],
+                "page_modes": cached["page_modes"],
+                "chunks": [],
+                "cached": True,
+                "duration": round(time.time() - s_time, 3)
+            }
+        try:
+            total_pages, cost = await asyncio.to_thread(inspect_pdf, file_path)
+        except Exception:
+            return {**item, "success": False, "error": "Invalid PDF file"}
+        try:
+            results = await parse_pdf_file(file_path, file_dir, total_pages, cost, tenant, parse_method, chunk_pages)
+        except ParseError as e:
+            return {**item, "success": False, "error": str(e)}
+        except Exception as e:
+            logger.error(f"Error in process_pdf_batch: {str(e)}")
+            return {**item, "success": False, "error": f"Internal server error: {str(e)}"}
+        await cache_store(digest, parse_method, results["text"], total_pages, results["page_modes"])
+        return {
+            **item,
+            "success": True,
+            "markdown": dedup_images(results["text"], image_dedup),
+            "pages": total_pages,
+            "page_modes": results["page_modes"],
+            "chunks": results["chunks"],
+            "cached": False,
+            "duration": round(time.time() - s_time, 3)
+        }
+
+    async def stream_results():
+        tasks = [asyncio.create_task(parse_one(*upload)) for upload in uploads]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done, ensure_ascii=False) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@app.post("/v2/parse/stream")
+async def process_pdf_stream(request: Request, file: UploadFile = File(...),
+                             parse_method: str = Query(PARSE_METHOD),
+                             image_dedup: str = Query(IMAGE_DEDUP_MODE),
+                             chunk_pages: int = Query(STREAM_CHUNK_PAGES),
+                             format: str = Query("ndjson")):
+    """按小块并行解析，按页序逐页返回 Markdown(NDJSON 或 SSE)，最后一行为汇总信息"""
+    s_time = time.time()
+    work_dir = tempfile.mkdtemp()
+    try:
+        pdf_path = os.path.join(work_dir, "upload.pdf")
+        await spool_upload(file, pdf_path)
+        try:
+            total_pages, cost = await asyncio.to_thread(inspect_pdf, pdf_path)
+        except fitz.FileDataError:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return JSONResponse(content={"success": False, "message": "", "error": "Invalid PDF file"}, status_code=400)
+        chunks = await asyncio.to_thread(split_pdf, pdf_path, work_dir, total_pages, max(chunk_pages, 1))
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    tenant = request_tenant(request)
+
+    def encode(event):
+        data = json.dumps(event, ensure_ascii=False)
+        return f"data: {data}\n\n" if format == "sse" else data + "\n"
+
+    async def stream_pages():
+        # 所有块同时进入调度队列，按页序等待，前面的块完成后立即输出
+        tasks = [asyncio.create_task(parse_chunk(start, end, chunk_path,
+                                                 cost * (end - start + 1) / max(total_pages, 1),
+                                                 tenant, parse_method, True))
+                 for start, end, chunk_path in chunks]
+        seen = set()
+        image_counts = Counter()
+        page_modes = []
+        try:
+            for (start, end, _), task in zip(chunks, tasks):
+                try:
+                    results = await task
+                except ParseError as e:
+                    yield encode({"success": False, "start_page": start, "end_page": end, "error": str(e)})
+                    return
+                modes = results.get("page_modes") or []
+                page_modes.extend(modes)
+                for offset, text in enumerate(results["page_texts"]):
+                    yield encode({
+                        "page": start + offset,
+                        "mode": modes[offset] if offset < len(modes) else None,
+                        "markdown": dedup_images(text, image_dedup, seen, image_counts)
+                    })
+            yield encode({
+                "success": True,
+                "done": True,
+                "pages": total_pages,
+                "page_modes": page_modes,
+                "duration": round(time.time() - s_time, 3)
+            })
+        finally:
+            for task in tasks:
+                task.cancel()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_pages(), media_type=media_type)
+
+async def spool_upload(file, path):
+    # 分块写入磁盘，不把整个上传文件读进内存，同时计算内容哈希
+    digest = hashlib.sha256()
+    with open(path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def cache_lookup(digest, parse_method):
+    if result_cache is None:
+        return None
+    return await asyncio.to_thread(result_cache.get, digest, parse_method)
+
+async def cache_store(digest, parse_method, text, pages, page_modes):
+    if result_cache is None:
+        return
+    entry = {"text": text, "pages": pages, "page_modes": page_modes}
+    try:
+        await asyncio.to_thread(result_cache.put, digest, parse_method, entry)
+    except OSError as e:
+        logger.warning(f"Failed to write result cache: {e}")
+
+@app.get("/health/ready")
+async def readiness():
+    # 只有所有 worker 都已加载并预热模型时才算就绪
+    workers = my_pool.stats() if my_pool else []
+    ready = bool(workers) and all(worker["ready"] for worker in workers)
+    return JSONResponse(content={
+        "ready": ready,
+        "workers": len(workers),
+        "warm_workers": sum(1 for worker in workers if worker["ready"])
+    }, status_code=200 if ready else 503)
+
+@app.get("/v2/workers")
+async def worker_stats():
+    return {
+        "success": True,
+        "message": "",
+        "max_jobs_per_worker": MAX_JOBS_PER_WORKER,
+        "max_worker_rss_mb": MAX_WORKER_RSS_MB,
+        "workers": my_pool.stats() if my_pool else [],
+        "scheduler": my_scheduler.stats() if my_scheduler else None,
+        "cache": result_cache.stats() if result_cache else None
+    }
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=7231)
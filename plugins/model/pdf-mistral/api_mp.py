@@ -1,38 +1,233 @@
 import time
+import asyncio
+import fcntl
 import base64
+import random
 import fitz
+import hashlib
 import re
 import json
+from abc import ABC, abstractmethod
+from collections import Counter
 from contextlib import asynccontextmanager
 from loguru import logger
-from fastapi import HTTPException, FastAPI, UploadFile, File
+from fastapi import HTTPException, FastAPI, UploadFile, File, Query
 from fastapi.responses import JSONResponse
+from io import StringIO
 from mistralai import Mistral
+from prometheus_client import Counter as PromCounter, make_asgi_app
+import httpx
 import os
 import shutil
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
 app = FastAPI()
+app.mount("/metrics", make_asgi_app())
 temp_dir = "./temp"
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Repeated images: "ref" inlines each distinct image once, "drop" removes repeated decorative images, "off" disables
+IMAGE_DEDUP_MODE = os.environ.get('IMAGE_DEDUP_MODE', 'ref')
+IMAGE_DECORATIVE_MIN_REPEATS = int(os.environ.get('IMAGE_DECORATIVE_MIN_REPEATS', 3))
+# Images in the returned markdown: "inline" embeds base64, "separate" returns them in an "images" list, "none" skips them
+INCLUDE_IMAGES = os.environ.get('INCLUDE_IMAGES', 'inline')
+MD_IMAGE_PATTERN = re.compile(r'!\[(.*?)\]\((.*?)\)')
+BASE64_IMAGE_PATTERN = re.compile(r'!\[([^\]]*)\]\((data:image/[^;]+;base64,([^)]+))\)')
+# Point the client at another Mistral-compatible server, e.g. stub_server.py for offline load tests
+MISTRAL_SERVER_URL = os.environ.get('MISTRAL_SERVER_URL') or None
+MISTRAL_OCR_MODEL = os.environ.get('MISTRAL_OCR_MODEL', 'mistral-ocr-latest')
+# Outstanding Mistral API requests per process; they share one pooled keep-alive connection pool
+MISTRAL_MAX_CONCURRENCY = int(os.environ.get('MISTRAL_MAX_CONCURRENCY', 16))
+MISTRAL_TIMEOUT = float(os.environ.get('MISTRAL_TIMEOUT', 300))
+# Client-side pacing sized to the account's rate limit, shared by all requests in the process (0 disables)
+MISTRAL_REQUESTS_PER_SECOND = float(os.environ.get('MISTRAL_REQUESTS_PER_SECOND', 5))
+MISTRAL_BURST = int(os.environ.get('MISTRAL_BURST', 10))
+# Retries for 429/5xx/connection errors: exponential backoff with full jitter, Retry-After wins when present
+MISTRAL_MAX_RETRIES = int(os.environ.get('MISTRAL_MAX_RETRIES', 5))
+MISTRAL_BACKOFF_BASE = float(os.environ.get('MISTRAL_BACKOFF_BASE', 1))
+MISTRAL_BACKOFF_MAX = float(os.environ.get('MISTRAL_BACKOFF_MAX', 60))
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+THROTTLED_SECONDS = PromCounter("mistral_throttled_seconds_total",
+                                "Time Mistral API calls spent waiting before being sent", ["reason"])
+API_RETRIES = PromCounter("mistral_api_retries_total", "Retried Mistral API calls", ["status"])
+# PDFs up to this size are sent inline as a base64 data URL instead of upload + signed URL (0 disables)
+MISTRAL_INLINE_MAX_MB = float(os.environ.get('MISTRAL_INLINE_MAX_MB', 4))
+# Remote deletes run in the background and are retried this many times before giving up
+MISTRAL_DELETE_RETRIES = int(os.environ.get('MISTRAL_DELETE_RETRIES', 5))
+DELETE_WORKERS = 4
+DELETE_DRAIN_TIMEOUT = 30
+# OCR result cache keyed by PDF content and model: size cap with LRU eviction (0 disables), optional TTL in seconds
+OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', './cache')
+OCR_CACHE_MAX_MB = int(os.environ.get('OCR_CACHE_MAX_MB', 1024))
+OCR_CACHE_TTL = int(os.environ.get('OCR_CACHE_TTL', 0))
+CACHE_REQUESTS = PromCounter("mistral_cache_requests_total", "OCR result cache lookups", ["result"])
+# PDFs longer than this are split into page ranges and OCR'd concurrently (0 disables)
+OCR_CHUNK_PAGES = int(os.environ.get('OCR_CHUNK_PAGES', 30))
 
 # Initialize Mistral client with API key from environment variable
 mistral_api_key = os.environ.get("MISTRAL_API_KEY", "")
 if not mistral_api_key:
     logger.warning("MISTRAL_API_KEY environment variable not set. PDF processing will fail.")
     
-mistral_client = Mistral(api_key=mistral_api_key) if mistral_api_key else None
+mistral_client = None
+ocr_backend = None
+mistral_http_client = None
+mistral_semaphore = None
+mistral_bucket = None
+delete_queue = None
+# Timer handles of failed deletes waiting to be re-queued
+delete_retries = set()
+result_cache = None
+
+class ResultCache:
+    """On-disk OCR result cache keyed by content hash.
+
+    Entries are written to a temp file and atomically renamed, and eviction holds a lock file in the
+    cache directory, so several processes can share one directory. Reads refresh the file's mtime and
+    eviction removes the least recently used entries first.
+    """
+
+    def __init__(self, directory, max_bytes, ttl=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock_path = os.path.join(directory, ".lock")
+        os.makedirs(directory, exist_ok=True)
+        self.approx_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _entries(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            if self.ttl and time.time() - entry.get("created_at", 0) > self.ttl:
+                os.remove(path)
+                entry = None
+            else:
+                os.utime(path)
+        except (OSError, ValueError):
+            entry = None
+        CACHE_REQUESTS.labels(result="hit" if entry else "miss").inc()
+        return entry
+
+    def put(self, key, entry):
+        data = json.dumps({**entry, "created_at": time.time()}, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.approx_bytes += len(data)
+        if self.approx_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self.approx_bytes = total
+
+class TokenBucket:
+    """Async token bucket; callers wait until a token is available and get the waited time back"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Create temp directory if it doesn't exist
-    global temp_dir
+    global temp_dir, mistral_client, mistral_http_client, mistral_semaphore, ocr_backend
     if not os.path.exists(temp_dir):
         os.makedirs(temp_dir)
     print("Application startup, creating temp directory...")
+    mistral_semaphore = asyncio.Semaphore(MISTRAL_MAX_CONCURRENCY)
+    global mistral_bucket
+    mistral_bucket = TokenBucket(MISTRAL_REQUESTS_PER_SECOND, MISTRAL_BURST)
+    if mistral_api_key:
+        mistral_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=MISTRAL_MAX_CONCURRENCY,
+                                max_keepalive_connections=MISTRAL_MAX_CONCURRENCY),
+            timeout=MISTRAL_TIMEOUT
+        )
+        # The SDK passes its own timeout with every request (None unless timeout_ms is set), overriding the client default
+        mistral_client = Mistral(api_key=mistral_api_key, server_url=MISTRAL_SERVER_URL,
+                                 async_client=mistral_http_client, timeout_ms=int(MISTRAL_TIMEOUT * 1000))
+        ocr_backend = MistralBackend(mistral_client, model=MISTRAL_OCR_MODEL)
+    global result_cache
+    if OCR_CACHE_MAX_MB > 0:
+        result_cache = ResultCache(OCR_CACHE_DIR, OCR_CACHE_MAX_MB * 1024 * 1024, OCR_CACHE_TTL)
+    global delete_queue
+    delete_queue = asyncio.Queue()
+    delete_workers = [asyncio.create_task(delete_worker()) for _ in range(DELETE_WORKERS)]
     yield
+    # Give pending remote deletes a chance to finish before the client goes away
+    try:
+        await asyncio.wait_for(delete_queue.join(), timeout=DELETE_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"{delete_queue.qsize() + len(delete_retries)} uploaded files were not deleted from Mistral servers")
+    for handle in delete_retries:
+        handle.cancel()
+    delete_retries.clear()
+    for task in delete_workers:
+        task.cancel()
+    if mistral_http_client is not None:
+        await mistral_http_client.aclose()
     if temp_dir and os.path.exists(temp_dir):
         shutil.rmtree(temp_dir)
     print("Application shutdown, cleaning up...")
@@ -41,22 +236,41 @@ app.router.lifespan_context = lifespan
 
 @app.post("/v1/parse/file")
 async def read_file(
-        file: UploadFile = File(...)):
-    temp_file_path = None
+        file: UploadFile = File(...),
+        image_dedup: str = Query(IMAGE_DEDUP_MODE),
+        include_images: str = Query(INCLUDE_IMAGES)):
+    scratch_dir = None
     try:
         start_time = time.time()
         global temp_dir
         os.makedirs(temp_dir, exist_ok=True)
-        temp_file_path = os.path.join(temp_dir, file.filename)
-        with open(temp_file_path, "wb") as temp_file:
-            file_content = await file.read()
-            temp_file.write(file_content)
+        # Each request gets its own scratch directory so concurrent uploads with the same filename do not collide
+        scratch_dir = tempfile.mkdtemp(dir=temp_dir)
+        temp_file_path = os.path.join(scratch_dir, "upload.pdf")
+        digest = await spool_upload(file, temp_file_path)
+        
+        # Identical uploads are answered from the cache without any Mistral calls
+        cache_key = hashlib.sha256(f"{digest}:{MISTRAL_OCR_MODEL}:{include_images}".encode()).hexdigest()
+        cached = await asyncio.to_thread(result_cache.get, cache_key) if result_cache else None
+        if cached:
+            result = {
+                "pages": cached["pages"],
+                "markdown": dedup_images(cached["markdown"], image_dedup) if include_images == "inline" else cached["markdown"],
+                "duration": time.time() - start_time,
+                "cached": True
+            }
+            if include_images == "separate":
+                result["images"] = cached["images"]
+            return result
         
+        # Read the spooled file once; page counting and the upload share the same bytes
+        with open(temp_file_path, "rb") as f:
+            pdf_bytes = f.read()
+
         # Get page count using PyMuPDF
         try:
-            pdf_document = fitz.open(temp_file_path)
-            total_pages = pdf_document.page_count
-            pdf_document.close()
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+                total_pages = pdf_document.page_count
         except Exception as e:
             logger.error(f"Failed to open PDF file: {str(e)}")
             return {
@@ -65,153 +279,56 @@ async def read_file(
                 "error": f"Failed to process PDF file: {str(e)}"
             }
         
-        if mistral_client is None:
+        if ocr_backend is None:
             return {
                 "pages": 0,
                 "markdown": "",
                 "error": "MISTRAL_API_KEY environment variable not set."
             }
         
-        # Step 1: Upload the file to Mistral's servers
-        logger.info(f"Uploading file {file.filename} to Mistral servers")
-        with open(temp_file_path, "rb") as f:
-            try:
-                uploaded_file = mistral_client.files.upload(
-                    file={
-                        "file_name": file.filename,
-                        "content": f,
-                    },
-                    purpose="ocr"
-                )
-            except Exception as e:
-                error_msg = str(e)
-                # Try to parse Mistral API error format
-                try:
-                    error_data = json.loads(error_msg)
-                    if error_data.get("object") == "error":
-                        error_msg = error_data.get("message", error_msg)
-                except:
-                    pass
-                
-                return {
-                    "pages": 0,
-                    "markdown": "",
-                    "error": f"Mistral API upload error: {error_msg}"
-                }
-        
-        # Step 2: Get a signed URL for the uploaded file
-        logger.info(f"Getting signed URL for file ID: {uploaded_file.id}")
+        # Large PDFs are split into page ranges that are OCR'd concurrently; only failed ranges are retried
+        chunks = await asyncio.to_thread(split_pdf_bytes, pdf_bytes, total_pages, OCR_CHUNK_PAGES)
+        tasks = [asyncio.create_task(ocr_chunk(file.filename, start, end, chunk_bytes, include_images != "none"))
+                 for start, end, chunk_bytes in chunks]
         try:
-            signed_url = mistral_client.files.get_signed_url(file_id=uploaded_file.id)
-        except Exception as e:
-            error_msg = str(e)
-            # Try to parse Mistral API error format
-            try:
-                error_data = json.loads(error_msg)
-                if error_data.get("object") == "error":
-                    error_msg = error_data.get("message", error_msg)
-            except:
-                pass
-            
+            chunk_pages = await asyncio.gather(*tasks)
+        except MistralOCRError as e:
+            for task in tasks:
+                task.cancel()
             return {
                 "pages": 0,
                 "markdown": "",
-                "error": f"Mistral API signed URL error: {error_msg}"
+                "error": str(e)
             }
         
-        # Step 3: Process the file using the signed URL
-        logger.info("Processing file with OCR API")
-        try:
-            ocr_response = mistral_client.ocr.process(
-                model="mistral-ocr-latest",
-                document={
-                    "type": "document_url",
-                    "document_url": signed_url.url,
-                },
-                include_image_base64=True
-            )
-        except Exception as e:
-            error_msg = str(e)
-            # Try to parse Mistral API error format
+        out = StringIO()
+        images = []
+        for (start, _, _), pages in zip(chunks, chunk_pages):
+            assemble_markdown(pages, start, include_images, out, images)
+        markdown_content = out.getvalue()
+        if result_cache:
             try:
-                error_data = json.loads(error_msg)
-                if error_data.get("object") == "error":
-                    error_msg = error_data.get("message", error_msg)
-            except:
-                pass
-            
-            return {
-                "pages": 0,
-                "markdown": "",
-                "error": f"Mistral OCR processing error: {error_msg}"
-            }
-        
-        # Combine all pages' markdown content
-        markdown_content = "\n".join(page.markdown for page in ocr_response.pages)
-        
-        # Create a dictionary to map image filenames to their base64 data
-        image_map = {}
-        for page in ocr_response.pages:
-            for img in page.images:
-                # Extract the image filename from the image id
-                img_id = img.id
-                img_base64 = img.image_base64
-                
-                # Print a sample of the first image base64 data for debugging
-                if len(image_map) == 0 and img_base64:
-                    print("Sample image base64 prefix:", img_base64[:50] if len(img_base64) > 50 else img_base64)
-                    print("Does base64 already include prefix?", img_base64.startswith("data:image/"))
-                
-                # Ensure the base64 data is in the correct format for the upstream system
-                # If it doesn't already have the prefix, add it
-                if not img_base64.startswith("data:image/"):
-                    # Assume it's a PNG if we can't determine the type
-                    img_base64 = f"data:image/png;base64,{img_base64}"
-                
-                # Add both potential formats to the map
-                image_map[f"{img_id}.jpeg"] = img_base64
-                image_map[f"{img_id}.png"] = img_base64
-                image_map[img_id] = img_base64
-        
-        # Use regex to find all image references in the markdown content
-        # This will match patterns like ![any-text](any-filename.extension)
-        image_pattern = r'!\[(.*?)\]\((.*?)\)'
-        
-        def replace_image_with_base64(match):
-            alt_text = match.group(1)
-            img_filename = match.group(2)
-            
-            # Extract just the filename without path
-            img_filename_only = os.path.basename(img_filename)
-            
-            # Check if we have base64 data for this image
-            if img_filename_only in image_map:
-                return f"![]({image_map[img_filename_only]})"
-            else:
-                # If we don't have base64 data, keep the original reference
-                logger.warning(f"No base64 data found for image: {img_filename_only}")
-                return match.group(0)
-        
-        # Replace all image references with base64 data
-        markdown_content = re.sub(image_pattern, replace_image_with_base64, markdown_content)
-        
-        # Clean up the uploaded file from Mistral's servers
-        try:
-            logger.info(f"Deleting uploaded file from Mistral servers: {uploaded_file.id}")
-            mistral_client.files.delete(file_id=uploaded_file.id)
-        except Exception as e:
-            logger.warning(f"Failed to delete uploaded file: {e}")
+                await asyncio.to_thread(result_cache.put, cache_key,
+                                        {"pages": total_pages, "markdown": markdown_content, "images": images})
+            except OSError as e:
+                logger.warning(f"Failed to write OCR cache: {e}")
+        if include_images == "inline":
+            markdown_content = dedup_images(markdown_content, image_dedup)
         
         end_time = time.time()
         duration = end_time - start_time
         print(file.filename + " Total time:", duration)
         
         # Return with format matching client expectations
-        return {
+        result = {
             "pages": total_pages,
             "markdown": markdown_content,
-            "duration": duration  # Keep this for logging purposes
+            "duration": duration,  # Keep this for logging purposes
+            "cached": False
         }
+        if include_images == "separate":
+            result["images"] = images
+        return result
 
     except Exception as e:
         logger.exception(e)
@@ -222,8 +339,284 @@ async def read_file(
         }
 
     finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        if scratch_dir and os.path.exists(scratch_dir):
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+class MistralOCRError(Exception):
+    pass
+
+class OcrBackend(ABC):
+    """Remote OCR operations used by the parser; another implementation can be swapped in for tests or benchmarks"""
+
+    @abstractmethod
+    async def upload(self, file_name, pdf_bytes):
+        """Store a document remotely and return its file id"""
+
+    @abstractmethod
+    async def signed_url(self, file_id):
+        """Return a URL the OCR call can read the uploaded document from"""
+
+    @abstractmethod
+    async def ocr(self, document_url, include_image_base64=True):
+        """OCR a document URL (https or data:) and return its pages, each with index, markdown and images"""
+
+    @abstractmethod
+    async def delete(self, file_id):
+        """Remove an uploaded document"""
+
+class MistralBackend(OcrBackend):
+    """Mistral SDK calls, paced by the token bucket and retried by call_mistral"""
+
+    def __init__(self, client, model="mistral-ocr-latest"):
+        self.client = client
+        self.model = model
+
+    async def upload(self, file_name, pdf_bytes):
+        uploaded_file = await call_mistral(
+            self.client.files.upload_async,
+            file={
+                "file_name": file_name,
+                "content": pdf_bytes,
+            },
+            purpose="ocr"
+        )
+        return uploaded_file.id
+
+    async def signed_url(self, file_id):
+        signed_url = await call_mistral(self.client.files.get_signed_url_async, file_id=file_id)
+        return signed_url.url
+
+    async def ocr(self, document_url, include_image_base64=True):
+        ocr_response = await call_mistral(
+            self.client.ocr.process_async,
+            model=self.model,
+            document={
+                "type": "document_url",
+                "document_url": document_url,
+            },
+            include_image_base64=include_image_base64
+        )
+        return ocr_response.pages
+
+    async def delete(self, file_id):
+        # delete_worker retries failed deletes itself, so a backoff here would only hold up its worker
+        await call_mistral(self.client.files.delete_async, max_retries=0, file_id=file_id)
+
+def mistral_error_message(e):
+    # Timeouts and other transport errors often have an empty message
+    error_msg = str(e) or type(e).__name__
+    # Try to parse Mistral API error format
+    try:
+        error_data = json.loads(error_msg)
+        if error_data.get("object") == "error":
+            error_msg = error_data.get("message", error_msg)
+    except:
+        pass
+    return error_msg
+
+def split_pdf_bytes(pdf_bytes, total_pages, chunk_pages):
+    """Split into [(start_page, end_page, pdf_bytes)] sub-documents of at most chunk_pages pages"""
+    if chunk_pages <= 0 or total_pages <= chunk_pages:
+        return [(0, total_pages - 1, pdf_bytes)]
+    chunks = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for start in range(0, total_pages, chunk_pages):
+            end = min(start + chunk_pages, total_pages) - 1
+            with fitz.open() as chunk_doc:
+                chunk_doc.insert_pdf(doc, from_page=start, to_page=end)
+                chunks.append((start, end, chunk_doc.tobytes()))
+    return chunks
+
+async def ocr_chunk(file_name, start, end, chunk_bytes, include_image_base64=True):
+    """OCR one page range and return its pages in order.
+
+    call_mistral already retries every API call, so the range is re-run at most once, and only for uploaded
+    documents where a fresh upload and signed URL can succeed where the original one failed. Rate limiting
+    is never retried here, as another pass would only add load.
+    """
+    uploaded = len(chunk_bytes) > MISTRAL_INLINE_MAX_MB * 1024 * 1024
+    try:
+        pages = await ocr_document(file_name, chunk_bytes, include_image_base64)
+    except MistralOCRError as e:
+        cause = e.__cause__
+        delay = retry_delay(cause, 0) if uploaded and cause is not None else None
+        if delay is None or getattr(cause, "status_code", None) == 429:
+            raise MistralOCRError(f"{e} (pages {start + 1}-{end + 1})") from cause
+        logger.warning(f"OCR of pages {start + 1}-{end + 1} failed, re-uploading in {delay:.1f}s: {e}")
+        await asyncio.sleep(delay)
+        try:
+            pages = await ocr_document(file_name, chunk_bytes, include_image_base64)
+        except MistralOCRError as e:
+            raise MistralOCRError(f"{e} (pages {start + 1}-{end + 1})") from e.__cause__
+    return sorted(pages, key=lambda page: page.index)
+
+async def ocr_document(file_name, pdf_bytes, include_image_base64=True):
+    """OCR one (sub-)document, either inline or uploaded and referenced through a signed URL"""
+    if len(pdf_bytes) <= MISTRAL_INLINE_MAX_MB * 1024 * 1024:
+        # Small documents skip the upload, signed URL and delete round trips entirely
+        document_url = "data:application/pdf;base64," + base64.b64encode(pdf_bytes).decode()
+        return await process_ocr(document_url, include_image_base64)
+
+    # Step 1: Upload the file to Mistral's servers
+    logger.info(f"Uploading file {file_name} to Mistral servers")
+    try:
+        file_id = await ocr_backend.upload(file_name, pdf_bytes)
+    except Exception as e:
+        raise MistralOCRError(f"Mistral API upload error: {mistral_error_message(e)}") from e
+    
+    try:
+        # Step 2: Get a signed URL for the uploaded file
+        logger.info(f"Getting signed URL for file ID: {file_id}")
+        try:
+            signed_url = await ocr_backend.signed_url(file_id)
+        except Exception as e:
+            raise MistralOCRError(f"Mistral API signed URL error: {mistral_error_message(e)}") from e
+        
+        # Step 3: Process the file using the signed URL
+        return await process_ocr(signed_url, include_image_base64)
+    finally:
+        # Deleting is off the critical path; the background workers retry it
+        delete_queue.put_nowait((file_id, 0))
+
+async def process_ocr(document_url, include_image_base64=True):
+    logger.info("Processing file with OCR API")
+    try:
+        return await ocr_backend.ocr(document_url, include_image_base64)
+    except Exception as e:
+        raise MistralOCRError(f"Mistral OCR processing error: {mistral_error_message(e)}") from e
+
+async def delete_worker():
+    while True:
+        file_id, attempt = await delete_queue.get()
+        try:
+            logger.info(f"Deleting uploaded file from Mistral servers: {file_id}")
+            await ocr_backend.delete(file_id)
+        except Exception as e:
+            delay = retry_delay(e, attempt) if attempt < MISTRAL_DELETE_RETRIES else None
+            if delay is not None:
+                logger.warning(f"Failed to delete uploaded file {file_id}, retrying in {delay:.1f}s: {e}")
+                schedule_delete_retry((file_id, attempt + 1), delay)
+                continue
+            logger.error(f"Giving up deleting uploaded file {file_id}: {e}")
+        delete_queue.task_done()
+
+def schedule_delete_retry(item, delay):
+    """Re-queue a failed delete after delay without holding a worker.
+
+    The failed item is only marked done once its retry is back in the queue, so delete_queue.join() waits for it.
+    """
+    def requeue():
+        delete_retries.discard(handle)
+        delete_queue.put_nowait(item)
+        delete_queue.task_done()
+
+    handle = asyncio.get_running_loop().call_later(delay, requeue)
+    delete_retries.add(handle)
+
+def assemble_markdown(pages, first_page, include_images, out, images):
+    """Write one chunk's pages into out in a single pass, resolving image references as they are met.
+
+    Image ids restart in every sub-document, so references resolve against their own chunk only.
+    With "separate" the images are appended to images under ids that are unique across chunks.
+    """
+    image_map = {img.id: img.image_base64 for page in pages for img in page.images}
+    for page in pages:
+        if out.tell():
+            out.write("\n")
+        markdown = page.markdown
+        pos = 0
+        for match in MD_IMAGE_PATTERN.finditer(markdown):
+            out.write(markdown[pos:match.start()])
+            pos = match.end()
+            # References may carry a path or an extension the id lacks
+            name = os.path.basename(match.group(2))
+            img_id = name if name in image_map else os.path.splitext(name)[0]
+            if img_id not in image_map:
+                logger.warning(f"No image found for reference: {name}")
+                out.write(match.group(0))
+                continue
+            img_base64 = image_map[img_id]
+            if include_images == "none" or not img_base64:
+                continue
+            if not img_base64.startswith("data:image/"):
+                # Assume it's a PNG if we can't determine the type
+                img_base64 = f"data:image/png;base64,{img_base64}"
+            if include_images == "separate":
+                ref = f"page{first_page + page.index + 1}-{img_id}"
+                images.append({"id": ref, "data": img_base64})
+                out.write(f"![{ref}]({ref})")
+            else:
+                out.write(f"![]({img_base64})")
+        out.write(markdown[pos:])
+
+def retry_delay(e, attempt):
+    """Seconds to wait before retrying e, or None if it should not be retried"""
+    if isinstance(e, httpx.TransportError):
+        status = None
+    else:
+        status = getattr(e, "status_code", None)
+        if status not in RETRYABLE_STATUS:
+            return None
+    response = getattr(e, "raw_response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), MISTRAL_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(MISTRAL_BACKOFF_MAX, MISTRAL_BACKOFF_BASE * 2 ** attempt))
+
+async def call_mistral(method, max_retries=MISTRAL_MAX_RETRIES, **kwargs):
+    for attempt in range(max_retries + 1):
+        THROTTLED_SECONDS.labels(reason="rate_limit").inc(await mistral_bucket.acquire())
+        # Bound the number of in-flight API calls so a burst of uploads queues here instead of at Mistral
+        try:
+            async with mistral_semaphore:
+                return await method(**kwargs)
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt == max_retries:
+                raise
+            status = getattr(e, "status_code", None) or type(e).__name__
+            API_RETRIES.labels(status=str(status)).inc()
+            THROTTLED_SECONDS.labels(reason="backoff").inc(delay)
+            logger.warning(f"Mistral API call failed ({status}), retrying in {delay:.1f}s: {e}")
+        # Back off outside the semaphore so other requests can use the slot meanwhile
+        await asyncio.sleep(delay)
+
+def dedup_images(md_content, mode):
+    # Inline each distinct image once and refer to it as ![img-<hash>](#img-<hash>) afterwards;
+    # "drop" removes images repeated often enough to be decoration (logos, headers)
+    if mode not in ("ref", "drop"):
+        return md_content
+    keys = [hashlib.sha1(match.group(3).encode()).hexdigest()[:16]
+            for match in BASE64_IMAGE_PATTERN.finditer(md_content)]
+    if len(keys) == len(set(keys)) and mode == "ref":
+        return md_content
+    counts = Counter(keys)
+    pending = iter(keys)
+    seen = set()
+
+    def replace(match):
+        key = next(pending)
+        if mode == "drop" and counts[key] >= IMAGE_DECORATIVE_MIN_REPEATS:
+            return ""
+        ref = f"img-{key}"
+        if key in seen:
+            return f"![{ref}](#{ref})"
+        seen.add(key)
+        return f"![{ref}]({match.group(2)})"
+
+    return BASE64_IMAGE_PATTERN.sub(replace, md_content)
+
+async def spool_upload(file, path):
+    # Write the upload to disk in chunks instead of reading it into memory, hashing it on the way
+    digest = hashlib.sha256()
+    with open(path, "wb") as temp_file:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            temp_file.write(chunk)
+            digest.update(chunk)
+    return digest.hexdigest()
 
 if __name__ == "__main__":
     import uvicorn
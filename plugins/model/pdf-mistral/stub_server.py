@@ -0,0 +1,133 @@
+"""Local stand-in for the Mistral files/OCR API, for load testing api_mp.py without network or API credits.
+
+Run it, then start the parser with MISTRAL_SERVER_URL=http://localhost:7232 and any MISTRAL_API_KEY.
+"""
+import asyncio
+import base64
+import os
+import random
+import time
+import uuid
+
+import fitz
+from fastapi import FastAPI, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse
+from loguru import logger
+
+# Fixed delay added to every request, in seconds
+STUB_LATENCY = float(os.environ.get('STUB_LATENCY', 0.2))
+# OCR throughput; an OCR call takes an extra pages / STUB_PAGES_PER_SECOND seconds (0 disables)
+STUB_PAGES_PER_SECOND = float(os.environ.get('STUB_PAGES_PER_SECOND', 10))
+# Fraction of requests answered with a 500 / a 429
+STUB_ERROR_RATE = float(os.environ.get('STUB_ERROR_RATE', 0))
+STUB_RATE_LIMIT_RATE = float(os.environ.get('STUB_RATE_LIMIT_RATE', 0))
+STUB_RETRY_AFTER = os.environ.get('STUB_RETRY_AFTER', '1')
+STUB_PORT = int(os.environ.get('STUB_PORT', 7232))
+
+app = FastAPI()
+files = {}
+stats = {"requests": 0, "errors": 0, "rate_limited": 0, "pages": 0}
+
+@app.middleware("http")
+async def simulate_service(request: Request, call_next):
+    stats["requests"] += 1
+    await asyncio.sleep(STUB_LATENCY)
+    if request.url.path.startswith("/v1/"):
+        roll = random.random()
+        if roll < STUB_RATE_LIMIT_RATE:
+            stats["rate_limited"] += 1
+            return JSONResponse(status_code=429, headers={"Retry-After": STUB_RETRY_AFTER},
+                                content={"object": "error", "message": "Requests rate limit exceeded", "type": "rate_limited"})
+        if roll < STUB_RATE_LIMIT_RATE + STUB_ERROR_RATE:
+            stats["errors"] += 1
+            return JSONResponse(status_code=500,
+                                content={"object": "error", "message": "Simulated server error", "type": "internal_error"})
+    return await call_next(request)
+
+def file_object(file_id, entry):
+    return {
+        "id": file_id,
+        "object": "file",
+        "bytes": len(entry["content"]),
+        "created_at": entry["created_at"],
+        "filename": entry["filename"],
+        "purpose": "ocr",
+        "sample_type": "ocr_input",
+        "source": "upload",
+        "num_lines": None
+    }
+
+@app.post("/v1/files")
+async def upload_file(file: UploadFile = File(...), purpose: str = Form("ocr")):
+    file_id = str(uuid.uuid4())
+    files[file_id] = {"content": await file.read(), "filename": file.filename, "created_at": int(time.time())}
+    return file_object(file_id, files[file_id])
+
+@app.get("/v1/files/{file_id}/url")
+async def signed_url(file_id: str, request: Request):
+    if file_id not in files:
+        return JSONResponse(status_code=404, content={"object": "error", "message": "File not found"})
+    return {"url": f"{str(request.base_url).rstrip('/')}/v1/files/{file_id}/content"}
+
+@app.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str):
+    if files.pop(file_id, None) is None:
+        return JSONResponse(status_code=404, content={"object": "error", "message": "File not found"})
+    return {"id": file_id, "object": "file", "deleted": True}
+
+def document_bytes(document_url):
+    if document_url.startswith("data:"):
+        return base64.b64decode(document_url.split(",", 1)[1])
+    file_id = document_url.rstrip("/").split("/")[-2]
+    return files[file_id]["content"]
+
+def ocr_pages(pdf_bytes, include_image_base64):
+    # Text layer as markdown plus one low resolution render of each page as its image
+    pages = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for index, page in enumerate(doc):
+            image_id = f"img-{index}.jpeg"
+            image_base64 = None
+            if include_image_base64:
+                pixmap = page.get_pixmap(matrix=fitz.Matrix(0.2, 0.2))
+                image_base64 = "data:image/jpeg;base64," + base64.b64encode(pixmap.tobytes("jpeg")).decode()
+            pages.append({
+                "index": index,
+                "markdown": f"{page.get_text('text').strip()}\n\n![{image_id}]({image_id})",
+                "images": [{
+                    "id": image_id,
+                    "top_left_x": 0,
+                    "top_left_y": 0,
+                    "bottom_right_x": int(page.rect.width),
+                    "bottom_right_y": int(page.rect.height),
+                    "image_base64": image_base64
+                }],
+                "dimensions": {"dpi": 72, "height": int(page.rect.height), "width": int(page.rect.width)}
+            })
+    return pages
+
+@app.post("/v1/ocr")
+async def ocr(request: Request):
+    body = await request.json()
+    try:
+        pdf_bytes = document_bytes(body["document"]["document_url"])
+    except (KeyError, IndexError, ValueError):
+        return JSONResponse(status_code=400, content={"object": "error", "message": "Invalid document_url"})
+    pages = await asyncio.to_thread(ocr_pages, pdf_bytes, body.get("include_image_base64") is not False)
+    if STUB_PAGES_PER_SECOND > 0:
+        await asyncio.sleep(len(pages) / STUB_PAGES_PER_SECOND)
+    stats["pages"] += len(pages)
+    return {
+        "pages": pages,
+        "model": body.get("model", "mistral-ocr-latest"),
+        "usage_info": {"pages_processed": len(pages), "doc_size_bytes": len(pdf_bytes)}
+    }
+
+@app.get("/stats")
+async def get_stats():
+    return {**stats, "stored_files": len(files)}
+
+if __name__ == "__main__":
+    import uvicorn
+    logger.info(f"Mistral stub listening on port {STUB_PORT}")
+    uvicorn.run(app, host="0.0.0.0", port=STUB_PORT)
@@ -0,0 +1,35 @@
+import { describe, expect, it } from 'vitest';
+import { matchMdImg } from '@fastgpt/global/common/string/markdown';
+
+describe('matchMdImg', () => {
+  it('should extract inline base64 images', () => {
+    const { text, imageList } = matchMdImg('a ![logo](data:image/png;base64,AAAA) b');
+
+    expect(imageList).toHaveLength(1);
+    expect(imageList[0].mime).toBe('image/png');
+    expect(imageList[0].base64).toBe('AAAA');
+    expect(text).toBe(`a ![logo](${imageList[0].uuid}) b`);
+  });
+
+  it('should resolve deduplicated image references to the first occurrence', () => {
+    const md = [
+      '![img-ab12](data:image/png;base64,AAAA)',
+      'page 1',
+      '![img-ab12](#img-ab12)',
+      'page 2',
+      '![img-ab12](#img-ab12)'
+    ].join('\n');
+    const { text, imageList } = matchMdImg(md);
+
+    expect(imageList).toHaveLength(1);
+    expect(text.split(imageList[0].uuid)).toHaveLength(4);
+    expect(text).not.toContain('#img-ab12');
+  });
+
+  it('should keep references without a matching image', () => {
+    const { text, imageList } = matchMdImg('![img-cd34](#img-cd34)');
+
+    expect(imageList).toHaveLength(0);
+    expect(text).toBe('![img-cd34](#img-cd34)');
+  });
+});